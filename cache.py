@@ -0,0 +1,124 @@
+"""
+Tools for caching expensive results on disk
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+cache_dir = 'cache'
+
+
+def file_hash(path):
+    """
+    The SHA-256 hash of a file's contents, as a hex string
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def key_of(*parts):
+    """
+    A hex key identifying the given parts.
+
+    The parts must have a stable repr, e.g. strings, numbers, and
+    tuples or sorted dicts of these.
+    """
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def array_hash(array):
+    """
+    The SHA-256 hash of a numpy array's shape, dtype and contents, as a hex string
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(repr((array.shape, array.dtype.str)).encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def frame_hash(df):
+    """
+    The SHA-256 hash of a DataFrame's index, columns and contents, as a hex string
+    """
+    digest = hashlib.sha256(repr((list(df.columns), list(df.dtypes.astype(str)))).encode())
+    digest.update(np.ascontiguousarray(pd.util.hash_pandas_object(df, index=True).to_numpy()).data)
+    return digest.hexdigest()
+
+
+def cache_path(kind, key, extension='pkl'):
+    return os.path.join(cache_dir, kind, f'{key}.{extension}')
+
+
+def load_or_build(kind, key, build, max_bytes=None):
+    """
+    Load the object stored under this kind and key, or build and store it.
+
+    A cache file that can't be read (e.g. because an earlier write was
+    interrupted, or the classes it refers to have changed) is rebuilt.
+
+    If max_bytes is given, the kind is kept to about that size by
+    evicting its least recently used files after each store. Loading a
+    file counts as using it.
+    """
+    path = cache_path(kind, key)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            if max_bytes is not None:
+                touch(path)
+            return result
+        except (OSError, EOFError, AttributeError, ImportError, pickle.UnpicklingError):
+            pass
+    result = build()
+    store(path, result)
+    if max_bytes is not None:
+        evict(kind, max_bytes)
+    return result
+
+
+def touch(path):
+    """Mark a cache file as just used"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def evict(kind, max_bytes):
+    """
+    Delete the least recently used files of a kind until the rest fit in max_bytes
+    """
+    kind_dir = os.path.join(cache_dir, kind)
+    entries = []
+    for entry in os.scandir(kind_dir):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def store(path, obj):
+    """
+    Pickle an object to the given path, replacing any existing file atomically
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
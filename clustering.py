@@ -0,0 +1,492 @@
+"""
+Hierarchical clustering of samples, and baselines to compare it against
+
+Linkages are cached on disk, keyed on the sample's values, and all the
+flat clusterings at a list of thresholds come out of one pass over the
+linkage. Baselines cluster copies of the sample with every feature
+shuffled independently (as in cluster.ipynb), many at once, so the real
+dendrogram can be compared to a null distribution rather than one
+shuffle. Clusterings can then be profiled, comparing the centroids of
+every pair of clusters at once.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.cluster import hierarchy
+
+import cache
+import parallel
+import walsdata
+
+# Bump this whenever a change to the clustering would make cached linkages stale
+linkage_version = 1
+
+
+def sample_values(sample):
+    """The table a sample is clustered on"""
+    return sample.values_scaled_imputed
+
+
+def linkage(sample, method='ward', use_cache=True):
+    """
+    The hierarchical clustering of a sample's languages, as a scipy linkage matrix.
+
+    Unless use_cache is False, the linkage is saved on disk, keyed on
+    the contents of the sample's values and on the method.
+    """
+    values = sample_values(sample)
+
+    def build():
+        return hierarchy.linkage(values.to_numpy(), method=method)
+
+    if not use_cache:
+        return build()
+    key = cache.key_of(linkage_version, cache.frame_hash(values), method)
+    return cache.load_or_build('linkage', key, build)
+
+
+def cut_all(linkage_matrix, thresholds):
+    """
+    The flat clusterings fcluster(linkage_matrix, t, criterion='distance')
+    would give at each threshold t, from one pass over the linkage.
+
+    Merges are applied in order of height with a union-find, and the
+    clustering is recorded as each threshold is passed. The clusters are
+    then numbered as fcluster numbers them (see fcluster_order).
+
+    Returns an array with a row of labels per threshold.
+    """
+    n = len(linkage_matrix) + 1
+    merged = linkage_matrix[:, :2].astype(np.intp)
+    # Like fcluster, a merge happens at the greatest height in its subtree,
+    # so non-monotonic linkages are cut the same way
+    heights = np.empty(n - 1)
+    for i, (a, b) in enumerate(merged):
+        heights[i] = max(
+            linkage_matrix[i, 2],
+            heights[a - n] if a >= n else -np.inf,
+            heights[b - n] if b >= n else -np.inf,
+        )
+
+    # Each leaf's representative, the leaves of each representative, the
+    # representative of each node and the topmost node of each representative
+    leaf_rep = np.arange(n)
+    members = {i: [i] for i in range(n)}
+    node_rep = np.arange(2 * n - 1)
+    rep_node = np.arange(n)
+
+    order = np.argsort(heights, kind='stable')
+    thresholds = np.asarray(thresholds, dtype=float)
+    result = np.empty((len(thresholds), n), dtype=np.intp)
+    visit_order = fcluster_order(linkage_matrix)
+    position = 0
+    for t in np.argsort(thresholds, kind='stable'):
+        while position < len(order) and heights[order[position]] <= thresholds[t]:
+            i = order[position]
+            a, b = node_rep[merged[i]]
+            # Union by size: move the smaller cluster's leaves
+            if len(members[a]) < len(members[b]):
+                a, b = b, a
+            leaf_rep[members[b]] = a
+            members[a].extend(members.pop(b))
+            node_rep[n + i] = a
+            rep_node[a] = n + i
+            position += 1
+        # Number the clusters in the order fcluster reaches their topmost nodes
+        _, labels = np.unique(visit_order[rep_node[leaf_rep]], return_inverse=True)
+        result[t] = labels + 1
+    return result
+
+
+def fcluster_order(linkage_matrix):
+    """
+    The order in which fcluster's traversal of the tree numbers each
+    node, if that node turns out to be a flat cluster.
+
+    The traversal is depth-first, reaching each merge before its
+    children and the left child before the right, but it only reaches
+    a merge's leaves once it has finished with any merges below it.
+    """
+    n = len(linkage_matrix) + 1
+    merged = linkage_matrix[:, :2].astype(np.intp)
+    order = np.full(2 * n - 1, -1)
+    counter = 0
+    stack = [2 * n - 2]
+    while stack:
+        node = stack[-1]
+        if order[node] < 0:
+            order[node] = counter
+            counter += 1
+        left, right = merged[node - n]
+        if left >= n and order[left] < 0:
+            stack.append(left)
+            continue
+        if right >= n and order[right] < 0:
+            stack.append(right)
+            continue
+        for child in (left, right):
+            if child < n:
+                order[child] = counter
+                counter += 1
+        stack.pop()
+    return order
+
+
+def cuts(sample, thresholds, method='ward'):
+    """
+    The flat clusterings of a sample at each threshold, as a table with a
+    row per language and a column per threshold
+    """
+    values = sample_values(sample)
+    return pd.DataFrame(
+        cut_all(linkage(sample, method=method), thresholds).T,
+        index=values.index,
+        columns=pd.Index(thresholds, name='threshold'),
+    )
+
+
+def shuffled_heights(
+    sample,
+    n_shuffles=100,
+    method='ward',
+    random_state=None,
+    max_workers=1,
+    chunk_size=10,
+):
+    """
+    The merge heights of the dendrograms of many shuffled copies of a sample.
+
+    Each shuffle permutes every feature independently across the
+    languages, destroying the correlations between features while
+    keeping each feature's distribution.
+
+    Parameters:
+    - sample: The sample to shuffle
+    - n_shuffles: The number of shuffled copies
+    - method: The linkage method
+    - random_state: Seed for the shuffles (see parallel.seeded_map_chunks)
+    - max_workers: The number of worker processes (None means one per CPU)
+    - chunk_size: The number of shuffles each worker task runs
+
+    Returns an array with a row of ascending merge heights per shuffle.
+    """
+    values = sample_values(sample).to_numpy()
+    return np.concatenate(list(parallel.seeded_map_chunks(
+        _shuffle_chunk,
+        n_shuffles,
+        chunk_size,
+        random_state,
+        max_workers,
+        args=(values, method),
+    )))
+
+
+def _shuffle_chunk(seeds, values, method):
+    heights = np.empty((len(seeds), len(values) - 1))
+    for i, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        # An independent permutation of the rows for each column
+        orders = np.argsort(rng.random(values.shape), axis=0)
+        shuffled = values[orders, np.arange(values.shape[1])]
+        heights[i] = np.sort(hierarchy.linkage(shuffled, method=method)[:, 2])
+    return heights
+
+
+def baseline_envelope(
+    sample,
+    n_shuffles=100,
+    method='ward',
+    quantiles=(0.025, 0.975),
+    random_state=None,
+    max_workers=1,
+):
+    """
+    Compare each merge of a sample's dendrogram to the same merge in
+    shuffled copies of the sample.
+
+    Merges are matched by rank: the merge leaving k clusters in the real
+    dendrogram against the merges leaving k clusters in the shuffles.
+
+    Returns a table indexed by the number of clusters left after the
+    merge, giving the real height, the median and the given quantiles
+    of the shuffled heights, how far the real height is above the upper
+    quantile, and its z-score against the shuffles.
+    """
+    real = np.sort(linkage(sample, method=method)[:, 2])
+    null = shuffled_heights(
+        sample,
+        n_shuffles=n_shuffles,
+        method=method,
+        random_state=random_state,
+        max_workers=max_workers,
+    )
+    n = len(real) + 1
+    result = pd.DataFrame(index=pd.Index(np.arange(n - 1, 0, -1), name='n_clusters'))
+    result['height'] = real
+    result['null_median'] = np.median(null, axis=0)
+    low, high = np.quantile(null, quantiles, axis=0)
+    result['null_low'] = low
+    result['null_high'] = high
+    result['above_envelope'] = real - high
+    result['z'] = (real - null.mean(axis=0)) / null.std(axis=0, ddof=1)
+    return result.iloc[::-1]
+
+
+def bootstrap_stability(
+    sample,
+    n_clusters=2,
+    n_rounds=200,
+    language_fraction=0.8,
+    resample_features=False,
+    method='ward',
+    random_state=None,
+    max_workers=1,
+    chunk_size=25,
+):
+    """
+    How stable a sample's clustering into n_clusters is under resampling.
+
+    Each round clusters a random subset of the languages (without
+    replacement) and, if resample_features is true, a bootstrap sample of
+    the features (with replacement), and cuts it into n_clusters. Rather
+    than keeping every round's labels, each worker counts, for every pair
+    of languages, how often they were sampled together and how often
+    they then landed in the same cluster, in uint16 matrices, and these
+    are summed as the workers finish.
+
+    Parameters:
+    - sample: The sample to cluster
+    - n_clusters: The number of clusters to cut each dendrogram into
+    - n_rounds: The number of resamples (at most 65535)
+    - language_fraction: The fraction of languages kept in each round
+      (1 to always keep them all)
+    - resample_features: Whether to bootstrap the features as well
+    - method: The linkage method
+    - random_state: Seed for the resamples (see parallel.seeded_map_chunks)
+    - max_workers: The number of worker processes (None means one per CPU)
+    - chunk_size: The number of rounds each worker task runs
+    """
+    if n_rounds > np.iinfo(np.uint16).max:
+        raise ValueError(f'At most {np.iinfo(np.uint16).max} rounds fit in the counts')
+    values = sample_values(sample)
+    n = len(values)
+    together = np.zeros((n, n), dtype=np.uint16)
+    cosampled = np.zeros((n, n), dtype=np.uint16)
+    counts = parallel.seeded_map_chunks(
+        _stability_chunk,
+        n_rounds,
+        chunk_size,
+        random_state,
+        max_workers,
+        args=(values.to_numpy(), n_clusters, language_fraction, resample_features, method),
+    )
+    for chunk_together, chunk_cosampled in counts:
+        together += chunk_together
+        cosampled += chunk_cosampled
+
+    labels = hierarchy.fcluster(linkage(sample, method=method), n_clusters, criterion='maxclust')
+    return Stability(values.index, labels, together, cosampled)
+
+
+def _stability_chunk(seeds, values, n_clusters, language_fraction, resample_features, method):
+    n, n_features = values.shape
+    n_kept = max(2, int(round(language_fraction * n)))
+    together = np.zeros((n, n), dtype=np.uint16)
+    cosampled = np.zeros((n, n), dtype=np.uint16)
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(n, n_kept, replace=False))
+        resampled = values[rows]
+        if resample_features:
+            resampled = resampled[:, rng.integers(n_features, size=n_features)]
+        labels = hierarchy.fcluster(
+            hierarchy.linkage(resampled, method=method), n_clusters, criterion='maxclust'
+        )
+        block = np.ix_(rows, rows)
+        together[block] += labels[:, None] == labels[None, :]
+        cosampled[block] += 1
+    return together, cosampled
+
+
+class Stability:
+    """
+    The results of bootstrap_stability.
+
+    Attributes:
+    - labels: The clustering of the whole sample, indexed by language
+    - together: For each pair of languages, the number of rounds they
+      were clustered together
+    - cosampled: For each pair of languages, the number of rounds they
+      were both sampled
+    - language_scores: For each language, how often it was clustered
+      with the other members of its cluster, when both were sampled
+    - cluster_scores: For each cluster, how often its members were
+      clustered together, when both were sampled
+    """
+    def __init__(self, languages, labels, together, cosampled):
+        self.labels = pd.Series(labels, index=languages, name='cluster')
+        self.together = together
+        self.cosampled = cosampled
+
+        association = self.association_matrix()
+        same = labels[:, None] == labels[None, :]
+        np.fill_diagonal(same, False)
+        with np.errstate(invalid='ignore'):
+            language_scores = np.nansum(np.where(same, association, 0), axis=1) / (
+                (same & ~np.isnan(association)).sum(axis=1)
+            )
+        self.language_scores = pd.Series(language_scores, index=languages, name='stability')
+
+        cluster_scores = {}
+        for label in np.unique(labels):
+            members = labels == label
+            pairs = association[np.ix_(members, members)][~np.eye(members.sum(), dtype=bool)]
+            cluster_scores[label] = np.nanmean(pairs) if len(pairs) else np.nan
+        self.cluster_scores = pd.Series(cluster_scores, name='stability')
+        self.cluster_scores.index.name = 'cluster'
+
+    def association_matrix(self):
+        """
+        For each pair of languages, the fraction of the rounds they were
+        both sampled in that they were clustered together (nan if never
+        sampled together)
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(
+                self.cosampled > 0, self.together / self.cosampled, np.nan
+            )
+
+    def association(self):
+        """association_matrix as a table indexed by language on both axes"""
+        return pd.DataFrame(
+            self.association_matrix(), index=self.labels.index, columns=self.labels.index
+        )
+
+
+def indicator(labels):
+    """
+    A sparse matrix with a row per language and a column per cluster,
+    with a 1 where the language is in the cluster, and the sorted
+    cluster labels labelling the columns
+    """
+    clusters, positions = np.unique(labels, return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(labels)), (np.arange(len(labels)), positions)),
+        shape=(len(labels), len(clusters)),
+    )
+    return matrix, clusters
+
+
+def centroids(values, labels):
+    """
+    The mean of values over each cluster, as a table with a row per cluster
+    """
+    matrix, clusters = indicator(labels)
+    sums = matrix.T @ values.to_numpy(dtype=float)
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    return pd.DataFrame(
+        sums / counts[:, None],
+        index=pd.Index(clusters, name='cluster'),
+        columns=values.columns,
+    )
+
+
+class Profile:
+    """
+    The centroids of a clustering, and how far apart every pair of
+    clusters is on every feature.
+
+    Attributes:
+    - centroids: The mean of each feature over each cluster
+    - differences: An array indexed by two clusters' positions in
+      centroids and a feature, giving the absolute difference between
+      the clusters' means
+    - ranking: The same shape as differences, giving for each pair of
+      clusters the features' positions ordered from the biggest
+      difference down
+    """
+    def __init__(self, values, labels):
+        self.centroids = centroids(values, labels)
+        means = self.centroids.to_numpy()
+        self.differences = np.abs(means[:, None, :] - means[None, :, :])
+        self.ranking = np.argsort(-self.differences, axis=2, kind='stable')
+
+    def most_distinct_features(self, cluster1, cluster2, count=10):
+        """
+        The features on which two clusters differ most, in the format of
+        cluster.ipynb's most_distinct_features (count=None gives every
+        feature with any difference)
+        """
+        i, j = self.centroids.index.get_indexer([cluster1, cluster2])
+        ranked = self.ranking[i, j]
+        diffs = self.differences[i, j, ranked]
+        if count is None:
+            ranked = ranked[diffs > 0]
+        else:
+            ranked = ranked[:count]
+        return _distinct_table(
+            self.centroids.columns[ranked],
+            self.differences[i, j, ranked],
+            cluster1,
+            self.centroids.iloc[i, ranked].to_numpy(),
+            cluster2,
+            self.centroids.iloc[j, ranked].to_numpy(),
+        )
+
+
+def profile_cuts(sample, thresholds, method='ward'):
+    """
+    The Profile of a sample's clustering at each threshold, as a dict
+    keyed by threshold
+    """
+    values = sample_values(sample)
+    labels = cut_all(linkage(sample, method=method), thresholds)
+    return {t: Profile(values, row) for t, row in zip(thresholds, labels)}
+
+
+def labels_for(sample, labels, languages):
+    """
+    The cluster label of each of the given languages, looked up all at once
+    """
+    positions = sample_values(sample).index.get_indexer(languages)
+    if (positions < 0).any():
+        missing = np.asarray(languages, dtype=object)[positions < 0]
+        raise KeyError(f'Languages not in the sample: {list(missing)}')
+    return np.asarray(labels)[positions]
+
+
+def most_distinct_features(sample, labels, cluster1, cluster2, count=10):
+    """
+    The features on which two clusters differ most.
+
+    Either cluster can also be a language ID, to compare against that
+    language alone (in which case labels may be None).
+    """
+    values = sample_values(sample)
+    means = []
+    for c in (cluster1, cluster2):
+        if c in values.index:
+            means.append(values.loc[c].to_numpy(dtype=float))
+        else:
+            means.append(centroids(values, labels).loc[c].to_numpy())
+    diff = np.abs(means[0] - means[1])
+    ranked = np.argsort(-diff, kind='stable')
+    if count is None:
+        ranked = ranked[diff[ranked] > 0]
+    else:
+        ranked = ranked[:count]
+    return _distinct_table(
+        values.columns[ranked], diff[ranked],
+        cluster1, means[0][ranked],
+        cluster2, means[1][ranked],
+    )
+
+
+def _distinct_table(features, diffs, cluster1, avg1, cluster2, avg2):
+    result = pd.DataFrame(index=features)
+    result['shortname'] = result.index.map(walsdata.get_shortname)
+    result['diff'] = diffs
+    result[f'cluster{cluster1}'] = avg1
+    result[f'cluster{cluster2}'] = avg2
+    return result
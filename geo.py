@@ -1,16 +1,26 @@
 """
 Geographical groups based on a DBSCAN clustering of the s280d sample
-"""
 
-import math
+The clustering is only run when labels or region_labels is first used.
+Every clustering runs on a haversine neighbour graph of the sample,
+queried once from a BallTree, so trying many settings of eps and
+min_samples is cheap.
+
+Also measures how clustered in space each feature is, with Moran's I.
+"""
 
-from sklearn import cluster
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
-from walsdata import s280d
+from sklearn import cluster, neighbors
 
+import spatial
+import walsdata
 
-dbscan = cluster.DBSCAN(metric='haversine', eps=0.12, min_samples=3)
-labels = dbscan.fit_predict(s280d.langs[['Latitude', 'Longitude']].applymap(math.radians))
+# The settings of the standard clustering
+eps = 0.12
+min_samples = 3
 
 region_names = {
     -1: 'Outlier',
@@ -31,4 +41,229 @@ region_names = {
     14: 'Indonesia/Malaysia',
 }
 
-region_labels = [region_names[label] for label in labels]
+_tree = None
+_core_trees = {}
+# The widest neighbour graph queried so far
+_graph = None
+_graph_radius = -1.0
+_dbscans = {}
+
+
+def radians(langs):
+    """The latitude and longitude of each language, in radians"""
+    return np.radians(langs[['Latitude', 'Longitude']].to_numpy(dtype=float))
+
+
+def tree():
+    """A haversine BallTree over the languages of s280d"""
+    global _tree
+    if _tree is None:
+        _tree = neighbors.BallTree(radians(walsdata.s280d.langs), metric='haversine')
+    return _tree
+
+
+def core_tree(eps, min_samples):
+    """
+    A haversine BallTree over the core languages of the DBSCAN clustering
+    with these settings, and the label of each core language
+    """
+    key = (eps, min_samples)
+    if key not in _core_trees:
+        dbscan = dbscan_for(eps, min_samples)
+        core = dbscan.core_sample_indices_
+        _core_trees[key] = (
+            neighbors.BallTree(radians(walsdata.s280d.langs)[core], metric='haversine'),
+            dbscan.labels_[core],
+        )
+    return _core_trees[key]
+
+
+def neighbour_graph(radius):
+    """
+    A sparse matrix of the haversine distances (in radians) between the
+    languages of s280d that are within radius of each other, including
+    each language's zero distance to itself.
+
+    The BallTree is only queried again for a radius wider than any
+    before it; narrower graphs are cut down from the widest one.
+    """
+    global _graph, _graph_radius
+    if radius > _graph_radius:
+        points = radians(walsdata.s280d.langs)
+        indices, distances = tree().query_radius(
+            points, radius, return_distance=True, sort_results=True
+        )
+        indptr = np.concatenate([[0], np.cumsum([len(row) for row in indices])])
+        _graph = sparse.csr_matrix(
+            (np.concatenate(distances), np.concatenate(indices), indptr),
+            shape=(len(points), len(points)),
+        )
+        _graph_radius = radius
+    if radius == _graph_radius:
+        return _graph
+    # Built by hand, so the zero distances stay stored
+    keep = _graph.data <= radius
+    indptr = np.concatenate([[0], np.cumsum(keep)])[_graph.indptr]
+    return sparse.csr_matrix(
+        (_graph.data[keep], _graph.indices[keep], indptr), shape=_graph.shape
+    )
+
+
+def dbscan_for(eps, min_samples):
+    """
+    The DBSCAN clustering of s280d with these settings, fitted on the
+    neighbour graph the first time it's asked for
+    """
+    key = (eps, min_samples)
+    if key not in _dbscans:
+        _dbscans[key] = cluster.DBSCAN(
+            metric='precomputed', eps=eps, min_samples=min_samples
+        ).fit(neighbour_graph(eps))
+    return _dbscans[key]
+
+
+def sweep(eps_values, min_samples_values):
+    """
+    The DBSCAN labels of the languages of s280d for every combination of
+    eps and min_samples.
+
+    The neighbour graph is queried once, at the widest eps. Returns a
+    table with a row per language and a column per (eps, min_samples).
+    """
+    neighbour_graph(max(eps_values))
+    columns = pd.MultiIndex.from_product(
+        [eps_values, min_samples_values], names=['eps', 'min_samples']
+    )
+    return pd.DataFrame(
+        np.column_stack([dbscan_for(e, m).labels_ for e, m in columns]),
+        index=pd.Index(walsdata.s280d.langs.ID, name='Language_ID'),
+        columns=columns,
+    )
+
+
+def assign_regions(langs=None, max_distance=eps):
+    """
+    The region of each language, as the region of the nearest core
+    language of the standard clustering.
+
+    Parameters:
+    - langs: The languages to place, with Latitude and Longitude columns
+      (by default, all of WALS)
+    - max_distance: Languages further than this (in radians) from every
+      core language are outliers. The default, the clustering's eps, is
+      how far DBSCAN itself reaches from a core language; None places
+      every language, however far away.
+
+    Returns a series of region names indexed by language ID.
+    """
+    if langs is None:
+        langs = walsdata.langs
+    tree, core_labels = core_tree(eps, min_samples)
+    distances, nearest = tree.query(radians(langs), k=1)
+    assigned = core_labels[nearest[:, 0]]
+    if max_distance is not None:
+        assigned = np.where(distances[:, 0] <= max_distance, assigned, -1)
+    names = np.array([region_names[label] for label in sorted(region_names)])
+    return pd.Series(
+        names[assigned - min(region_names)],
+        index=pd.Index(langs.ID, name='Language_ID'),
+    )
+
+
+def spatial_weights(ids, k=8, radius=None):
+    """
+    A sparse, row-standardised spatial weights matrix over the given languages.
+
+    Parameters:
+    - ids: The language IDs, in the order of the matrix's rows
+    - k: Each language's neighbours are its k nearest other languages
+    - radius: If given, each language's neighbours are instead all the
+      other languages within this many km (a language with none gets
+      an empty row)
+    """
+    ids = list(ids)
+    n = len(ids)
+    if radius is None:
+        neighbours, _ = spatial.nearest(ids, k, among=ids)
+        cols = pd.Index(ids).get_indexer(neighbours.to_numpy().ravel())
+        rows = np.repeat(np.arange(n), k)
+    else:
+        found = spatial.within(ids, radius, among=ids)
+        cols = np.concatenate([pd.Index(ids).get_indexer(row) for row in found])
+        rows = np.repeat(np.arange(n), [len(row) for row in found])
+        not_self = rows != cols
+        rows, cols = rows[not_self], cols[not_self]
+    counts = np.bincount(rows, minlength=n)
+    weights = 1.0 / counts[rows]
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+
+def morans_i(values, weights=None, permutations=999, random_state=None, batch_size=None):
+    """
+    Moran's I, with a permutation test, for every column of a table at once.
+
+    Each permutation shuffles the languages, the same way for every
+    column, and the statistic for every column and a whole batch of
+    permutations comes out of a single sparse matrix product.
+
+    Parameters:
+    - values: A table of features with a row per language, indexed by
+      language ID, e.g. a sample's values_scaled_imputed
+    - weights: A spatial weights matrix over the rows of values (by
+      default, spatial_weights of the languages)
+    - permutations: The number of permutations (0 for none)
+    - random_state: Seed for the permutations
+    - batch_size: The number of permutations per product (by default,
+      enough to make the product about a million cells)
+
+    Returns a table with a row per column of values, giving I, its
+    expected value with no spatial autocorrelation, and, if there
+    were permutations, the z-score of I against the permutations and
+    the pseudo p-value (one-tailed in the direction of the observed I,
+    as in pysal's p_sim).
+    """
+    if weights is None:
+        weights = spatial_weights(values.index)
+    z = values.to_numpy(dtype=float)
+    z = z - z.mean(axis=0)
+    n, n_columns = z.shape
+    # n / S0 / z'z, which no permutation changes
+    scale = n / weights.sum() / (z ** 2).sum(axis=0)
+
+    result = pd.DataFrame(index=values.columns)
+    observed = scale * (z * (weights @ z)).sum(axis=0)
+    result['I'] = observed
+    result['expected_I'] = -1 / (n - 1)
+    if not permutations:
+        return result
+
+    if batch_size is None:
+        batch_size = max(1, (1 << 20) // z.size)
+    rng = np.random.default_rng(random_state)
+    null = np.empty((permutations, n_columns))
+    for start in range(0, permutations, batch_size):
+        size = min(batch_size, permutations - start)
+        orders = np.argsort(rng.random((size, n)), axis=1)
+        # Side by side: the columns of the first permutation, then the second...
+        shuffled = z[orders].transpose(1, 0, 2).reshape(n, size * n_columns)
+        products = (shuffled * (weights @ shuffled)).sum(axis=0)
+        null[start:start + size] = scale * products.reshape(size, n_columns)
+
+    larger = (null >= observed).sum(axis=0)
+    larger = np.minimum(larger, permutations - larger)
+    result['z_sim'] = (observed - null.mean(axis=0)) / null.std(axis=0, ddof=1)
+    result['p_sim'] = (larger + 1) / (permutations + 1)
+    return result
+
+
+def __getattr__(name):
+    if name == 'dbscan':
+        return dbscan_for(eps, min_samples)
+    if name == 'labels':
+        result = dbscan_for(eps, min_samples).labels_
+    elif name == 'region_labels':
+        result = [region_names[label] for label in dbscan_for(eps, min_samples).labels_]
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = result
+    return result
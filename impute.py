@@ -0,0 +1,349 @@
+"""
+Nearest-neighbour imputation of missing feature values
+
+This does the same job as sklearn's KNNImputer(weights='distance'), but
+scales to thousands of languages. Nan-euclidean distances are computed in
+blocks of rows with float32 buffers, and only each language's nearest
+candidates are kept (with their distances recomputed exactly), so there's
+never an n x n float64 matrix in memory. An imputer builds the neighbour
+graph of the table it was fitted on once, and reuses it for every
+imputation of that table.
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn import base
+
+import parallel
+
+# Bump this whenever a change to the imputation would make cached results stale
+imputer_version = 2
+
+# The most float32 cells to hold in one block of distances
+max_block_cells = 1 << 24
+
+# How close (in squared distance per column) a donor can get to the cut
+# between candidates and non-candidates before it's checked exactly
+cut_margin = 1e-4
+
+
+def nan_euclidean_block(x, y, x_present, y_present):
+    """
+    Approximate nan-euclidean distances between the rows of x and of y.
+
+    As in sklearn, the squared distance between two rows is the sum of
+    squared differences over the columns both have, scaled up by the
+    fraction of columns both have; rows sharing no columns are at a
+    distance of nan. The inputs must be float32, with missing values
+    replaced by 0 and the masks of present values given separately.
+    """
+    squared = (
+        (x * x) @ y_present.T
+        + x_present @ (y * y).T
+        - 2 * (x @ y.T)
+    )
+    shared = x_present @ y_present.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = np.sqrt(np.maximum(squared, 0) * (x.shape[1] / shared))
+    distances[shared == 0] = np.nan
+    return distances
+
+
+def nan_euclidean_exact(x, y):
+    """
+    Exact nan-euclidean distances between each row of x and the rows of y
+    paired with it (y has one more dimension than x)
+    """
+    diffs = x[:, np.newaxis, :] - y
+    present = ~np.isnan(diffs)
+    squared = np.where(present, diffs, 0.0)
+    squared = (squared * squared).sum(axis=-1)
+    shared = present.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(shared > 0, np.sqrt(squared * (x.shape[-1] / shared)), np.nan)
+
+
+class NeighbourGraph:
+    """
+    Each receiver row's nearest donor rows, nearest first.
+
+    Candidates are chosen by float32 distances computed in blocks, then
+    their distances are recomputed exactly in float64 and the candidates
+    re-sorted by distance (ties going to the lower row). Donors at a nan
+    distance sort last. The approximate distance of the nearest donor
+    that didn't make the cut is kept too, so users of the graph can tell
+    when a candidate is too close to the cut to be trusted.
+
+    Parameters:
+    - receivers: A 2D float array, with nan for missing values
+    - donors: Another 2D float array with the same columns
+    - n_candidates: How many candidates to keep for each receiver
+    """
+    def __init__(self, receivers, donors, n_candidates):
+        self.n_candidates = min(n_candidates, len(donors))
+        # Whether every donor is a candidate for every receiver
+        self.complete = self.n_candidates == len(donors)
+        self.candidates = np.empty((len(receivers), self.n_candidates), dtype=np.intp)
+        self.distances = np.empty((len(receivers), self.n_candidates))
+        # The approximate distance of each receiver's nearest non-candidate
+        self.cutoffs = np.full(len(receivers), np.inf)
+
+        donors32 = np.nan_to_num(donors).astype(np.float32)
+        donors_present = (~np.isnan(donors)).astype(np.float32)
+        block_rows = max(1, max_block_cells // max(1, len(donors)))
+        for start in range(0, len(receivers), block_rows):
+            block = receivers[start:start + block_rows]
+            approx = nan_euclidean_block(
+                np.nan_to_num(block).astype(np.float32),
+                donors32,
+                (~np.isnan(block)).astype(np.float32),
+                donors_present,
+            )
+            approx[np.isnan(approx)] = np.inf
+            if self.n_candidates < len(donors):
+                partitioned = np.argpartition(approx, self.n_candidates, axis=1)
+                candidates = partitioned[:, :self.n_candidates]
+                self.cutoffs[start:start + len(block)] = np.take_along_axis(
+                    approx, partitioned[:, self.n_candidates:self.n_candidates + 1], axis=1
+                )[:, 0]
+            else:
+                candidates = np.broadcast_to(np.arange(len(donors)), approx.shape)
+            distances = nan_euclidean_exact(block, donors[candidates])
+            order = np.lexsort(
+                (candidates, np.where(np.isnan(distances), np.inf, distances)), axis=1
+            )
+            self.candidates[start:start + len(block)] = np.take_along_axis(
+                candidates, order, axis=1
+            )
+            self.distances[start:start + len(block)] = np.take_along_axis(
+                distances, order, axis=1
+            )
+
+
+def impute(receivers, donors, graph, n_neighbors=5):
+    """
+    Fill in the missing values of the receivers from their nearest donors.
+
+    For each column, a receiver missing it takes the distance-weighted
+    mean of the n_neighbors nearest donors that have it, ignoring donors
+    at a nan distance; if any of these donors are at a distance of zero,
+    only they count. A receiver with no donor at a finite distance takes
+    the column mean. Receivers whose candidates in the graph don't
+    include enough donors fall back to exact distances to every donor.
+    """
+    result = receivers.copy()
+    for col, rows, values, weights in column_donors(receivers, donors, graph, n_neighbors):
+        total = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (weights * values).sum(axis=1) / total
+        default = donors[~np.isnan(donors[:, col]), col].mean()
+        result[rows, col] = np.where(total > 0, means, default)
+    return result
+
+
+def multiple_impute(
+    receivers,
+    donors,
+    graph,
+    n_imputations,
+    n_neighbors=5,
+    random_state=None,
+    max_workers=1,
+    chunk_size=16,
+):
+    """
+    Draw several stochastic imputations of the receivers' missing values,
+    stacked into an array of shape (n_imputations, *receivers.shape).
+
+    Each missing value is copied from one of the donors impute would
+    average over, chosen with probability proportional to its weight;
+    a receiver with no donor at a finite distance copies a random donor.
+    The nearest donors are only found once, and each chunk of chunk_size
+    imputations is then drawn in one vectorized pass, from its own seed
+    spawned from random_state, so the result doesn't depend on
+    max_workers. Chunks are spread over max_workers processes with
+    parallel.map_chunks.
+    """
+    plan = []
+    for col, rows, values, weights in column_donors(receivers, donors, graph, n_neighbors):
+        total = weights.sum(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            probabilities = np.where(total > 0, weights / total, 0.0)
+        plan.append((col, rows, values, probabilities, donors[~np.isnan(donors[:, col]), col]))
+
+    sizes = [
+        min(chunk_size, n_imputations - start)
+        for start in range(0, n_imputations, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+    chunks = list(parallel.map_chunks(
+        _draw_chunks, list(zip(sizes, seeds)), 1, max_workers, args=(receivers, plan)
+    ))
+    if not chunks:
+        return np.empty((0,) + receivers.shape)
+    return np.concatenate(chunks)
+
+
+def draw_imputations(receivers, plan, size, seed):
+    """Draw size imputations following a plan made by multiple_impute"""
+    rng = np.random.default_rng(seed)
+    result = np.repeat(receivers[np.newaxis], size, axis=0)
+    for col, rows, values, probabilities, pool in plan:
+        has_donor = probabilities.sum(axis=1) > 0
+        # Never pick past the last donor with any weight, whatever the rounding
+        last = probabilities.shape[1] - 1 - np.argmax(probabilities[:, ::-1] > 0, axis=1)
+        cumulative = np.cumsum(probabilities, axis=1)
+        draws = rng.random((size, len(rows)))
+        picks = np.minimum(
+            (draws[:, :, np.newaxis] >= cumulative[np.newaxis]).sum(axis=2), last
+        )
+        drawn = values[np.arange(len(rows)), picks]
+        if not has_donor.all():
+            drawn[:, ~has_donor] = rng.choice(pool, size=(size, (~has_donor).sum()))
+        result[:, rows, col] = drawn
+    return result
+
+
+def _draw_chunks(chunks, receivers, plan):
+    return np.concatenate([
+        draw_imputations(receivers, plan, size, seed) for size, seed in chunks
+    ])
+
+
+def column_donors(receivers, donors, graph, n_neighbors):
+    """
+    For each column the receivers are missing values in, the donors to
+    impute them from.
+
+    Yields the column, the receiver rows missing it, and for each of
+    those rows the values and weights of its n_neighbors nearest donors
+    having the column (padded with zero weights). A row with all zero
+    weights has no donor at a finite distance.
+    """
+    missing = np.isnan(receivers)
+    donor_missing = np.isnan(donors)
+    valid = np.isfinite(graph.distances) & (graph.candidates >= 0)
+    candidates = np.where(graph.candidates >= 0, graph.candidates, 0)
+    for col in np.flatnonzero(missing.any(axis=0)):
+        has_col = ~donor_missing[:, col]
+        n_donors = has_col.sum()
+        if n_donors == 0:
+            continue
+        k = min(n_neighbors, n_donors)
+        rows = np.flatnonzero(missing[:, col])
+        usable = valid[rows] & has_col[candidates[rows]]
+        taken = usable & (np.cumsum(usable, axis=1) <= k)
+        n_taken = taken.sum(axis=1)
+
+        first = np.argsort(~taken, axis=1, kind='stable')[:, :k]
+        chosen = np.take_along_axis(taken, first, axis=1)
+        donor_rows = np.take_along_axis(candidates[rows], first, axis=1)
+        distances = np.take_along_axis(graph.distances[rows], first, axis=1)
+        # A donor near the cut might be tied with, or beaten by, a donor
+        # that missed it because of rounding in the float32 distances
+        farthest = np.where(chosen, distances, 0.0).max(axis=1, initial=0.0)
+        near_cut = farthest ** 2 >= graph.cutoffs[rows] ** 2 - cut_margin * receivers.shape[1]
+        fallback = ((n_taken < k) | near_cut) & (not graph.complete)
+        weights = donor_weights(distances, chosen)
+        values = np.where(chosen, donors[donor_rows, col], 0.0)
+        if weights.shape[1] < k:
+            # The graph has fewer candidates than neighbours to find
+            padding = ((0, 0), (0, k - weights.shape[1]))
+            weights = np.pad(weights, padding)
+            values = np.pad(values, padding)
+
+        for i in np.flatnonzero(fallback):
+            donor_rows = np.flatnonzero(has_col)
+            distances = nan_euclidean_exact(
+                receivers[rows[i]][np.newaxis, :], donors[donor_rows][np.newaxis, :, :]
+            )[0]
+            finite = np.isfinite(distances)
+            order = np.lexsort((donor_rows[finite], distances[finite]))[:k]
+            chosen_row = np.zeros(k, dtype=bool)
+            chosen_row[:len(order)] = True
+            distances_row = np.ones(k)
+            distances_row[:len(order)] = distances[finite][order]
+            weights[i] = donor_weights(distances_row[np.newaxis], chosen_row[np.newaxis])[0]
+            values[i] = 0.0
+            values[i, :len(order)] = donors[donor_rows[finite][order], col]
+
+        yield col, rows, values, weights
+
+
+def donor_weights(distances, chosen):
+    """
+    Inverse-distance weights of the chosen donors in each row, giving all
+    the weight to the zero-distance donors in rows that have any
+    """
+    zero = chosen & (distances == 0)
+    with np.errstate(divide='ignore'):
+        weights = np.where(chosen, 1 / np.where(chosen, distances, 1), 0.0)
+    return np.where(zero.any(axis=1, keepdims=True), zero.astype(float), weights)
+
+
+class NeighbourImputer(base.TransformerMixin):
+    """
+    A drop-in replacement for KNNImputer(weights='distance') built on
+    NeighbourGraph.
+
+    The neighbour graph of the table the imputer was fitted on is built
+    the first time that table is imputed, and kept for imputing it again
+    or drawing multiple imputations of it.
+
+    Parameters:
+    - n_neighbors: How many donors to average over
+    - n_candidates: How many candidates to keep for each language in the
+      neighbour graph (by default, 4 * n_neighbors + 1)
+    """
+    def __init__(self, n_neighbors=5, n_candidates=None):
+        self.n_neighbors = n_neighbors
+        self.n_candidates = n_candidates
+
+    def _candidates(self):
+        if self.n_candidates is None:
+            return 4 * self.n_neighbors + 1
+        return self.n_candidates
+
+    def fit(self, x, y=None):
+        self._fit_x = as_frame(x).to_numpy(dtype=float)
+        self._fit_graph = None
+        return self
+
+    def transform(self, x):
+        values = as_frame(x).to_numpy(dtype=float)
+        return impute(values, self._fit_x, self._graph(values), self.n_neighbors)
+
+    def _is_fitted_table(self, values):
+        return values.shape == self._fit_x.shape and np.array_equal(
+            values, self._fit_x, equal_nan=True
+        )
+
+    def _graph(self, values):
+        """The neighbour graph of values among the rows the imputer was fitted on"""
+        if not self._is_fitted_table(values):
+            return NeighbourGraph(values, self._fit_x, self._candidates())
+        if self._fit_graph is None:
+            self._fit_graph = NeighbourGraph(self._fit_x, self._fit_x, self._candidates())
+        return self._fit_graph
+
+    def sample(self, x, n_imputations, random_state=None, max_workers=1):
+        """
+        Draw n_imputations stochastic imputations of x, stacked into one
+        array (see multiple_impute)
+        """
+        values = as_frame(x).to_numpy(dtype=float)
+        return multiple_impute(
+            values,
+            self._fit_x,
+            self._graph(values),
+            n_imputations,
+            n_neighbors=self.n_neighbors,
+            random_state=random_state,
+            max_workers=max_workers,
+        )
+
+
+def as_frame(x):
+    if isinstance(x, pd.DataFrame):
+        return x
+    return pd.DataFrame(x)
@@ -1,15 +1,33 @@
 """
 Tools for plotting languages and language features on the world map
+
+The world layer is only read when first needed, and is drawn once into
+a raster background, saved in the cache. Every map after that is the
+background image plus a scatter of the languages, so drawing many maps
+(e.g. one per clustering cut or per feature) costs little more than
+drawing their points. For vector output (PDF or SVG), the maps can
+draw the world's polygons instead.
 """
 
+import os
+
 import numpy as np
 
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
+from matplotlib.lines import Line2D
 import geopandas as gpd
 
+import cache
+
+# Bump this whenever a change to the drawing would make saved backgrounds stale
+background_version = 1
 
-world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+# The width of the background raster in pixels, about the width of the
+# map in a 16x10 inch figure at 100 dpi, so drawing it needs no resampling
+background_width = 1280
+
+marker_size = 35
 
 # Adapted from Kenneth Kelly's maximally contrastive colour list
 colors = np.array(
@@ -38,21 +56,218 @@ colors = np.array(
     ]
 ) / 256
 
+_world = None
+_backgrounds = {}
 
-def plot(points, labels=None):
-    fig, ax = plt.subplots(figsize=(16, 10))
-    world.plot(ax=ax, color='w', edgecolor='k', linewidth=0.5)
-    if labels is None:
-        points.plot(ax=ax, marker='o', color='b', markersize=35)
-    else:
-        labelled_points = points.copy()
-        labelled_points['label'] = labels
-        num_unique_labels = len(np.unique(labels))
-        cmap = ListedColormap(colors[:num_unique_labels])
-        labelled_points.plot(
-            ax=ax, marker='o', column='label', markersize=35,
-            cmap=cmap, categorical=True,
-            legend=True, legend_kwds={
-                'loc': 'lower left'
-            }
+
+def world_path():
+    return gpd.datasets.get_path('naturalearth_lowres')
+
+
+def world_layer():
+    """The world's country polygons, read the first time they're needed"""
+    global _world
+    if _world is None:
+        _world = gpd.read_file(world_path())
+    return _world
+
+
+def extent(layer):
+    """The (left, right, bottom, top) bounds of a layer"""
+    left, bottom, right, top = layer.total_bounds
+    return left, right, bottom, top
+
+
+def aspect(bounds):
+    """The aspect ratio geopandas gives a plot in degrees spanning these bounds"""
+    left, right, bottom, top = bounds
+    return 1 / np.cos(np.radians((bottom + top) / 2))
+
+
+def background(width=background_width):
+    """
+    The world layer drawn as an RGBA image, width pixels wide, and its
+    (left, right, bottom, top) extent in degrees.
+
+    Rendered once per shapefile and width, then loaded from the cache.
+    """
+    if width not in _backgrounds:
+        key = cache.key_of(background_version, cache.file_hash(world_path()), width)
+        _backgrounds[width] = cache.load_or_build(
+            'basemap', key, lambda: render_background(width)
+        )
+    return _backgrounds[width]
+
+
+def render_background(width):
+    """Draw the world layer into an RGBA image; see background"""
+    layer = world_layer()
+    bounds = extent(layer)
+    left, right, bottom, top = bounds
+    height = int(round(width * (top - bottom) / (right - left) * aspect(bounds)))
+    dpi = 100
+    fig = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    try:
+        ax = fig.add_axes([0, 0, 1, 1])
+        layer.plot(ax=ax, color='w', edgecolor='k', linewidth=0.5)
+        ax.set_aspect('auto')
+        ax.set_xlim(left, right)
+        ax.set_ylim(bottom, top)
+        ax.axis('off')
+        fig.canvas.draw()
+        image = np.array(fig.canvas.buffer_rgba())
+    finally:
+        plt.close(fig)
+    return image, bounds
+
+
+def draw_background(ax, width=background_width):
+    """
+    Draw the cached world background on ax, with the world layer's
+    framing. A wider background is sharper in large or high-resolution
+    figures, but slower to draw.
+    """
+    image, bounds = background(width)
+    ax.imshow(image, extent=bounds, interpolation='nearest', zorder=0)
+    ax.set_xlim(bounds[0], bounds[1])
+    ax.set_ylim(bounds[2], bounds[3])
+    ax.set_aspect(aspect(bounds))
+    return ax
+
+
+def draw_world(ax, background='raster', width=background_width):
+    """
+    Draw the world on ax, either as the cached raster background
+    ('raster') or as the world layer's polygons ('vector'), which is
+    slower but stays sharp at any size
+    """
+    if background == 'raster':
+        return draw_background(ax, width)
+    if background == 'vector':
+        world_layer().plot(ax=ax, color='w', edgecolor='k', linewidth=0.5)
+        return ax
+    raise ValueError(f'Unknown background {background!r}')
+
+
+def label_colors(labels):
+    """
+    The categories of labels, sorted, and a colour for each label, as
+    geopandas would colour them with a categorical plot
+    """
+    categories, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    cmap = ListedColormap(colors[:len(categories)])
+    palette = cmap(np.arange(len(categories)))
+    return categories, palette, palette[inverse]
+
+
+def legend_handles(categories, palette):
+    return [
+        Line2D(
+            [], [], linestyle='none', marker='o', markersize=10,
+            markerfacecolor=color, markeredgecolor='none', label=str(category),
         )
+        for category, color in zip(categories, palette)
+    ]
+
+
+def draw_points(ax, points, labels=None, legend=True):
+    """
+    Scatter the languages (a GeoDataFrame of points) on ax, coloured by
+    labels if given. Returns the scatter.
+    """
+    x, y = points.geometry.x.to_numpy(), points.geometry.y.to_numpy()
+    if labels is None:
+        return ax.scatter(x, y, marker='o', color='b', s=marker_size)
+    categories, palette, point_colors = label_colors(labels)
+    result = ax.scatter(x, y, marker='o', c=point_colors, s=marker_size)
+    if legend:
+        ax.legend(handles=legend_handles(categories, palette), loc='lower left')
+    return result
+
+
+def plot(points, labels=None, background='raster'):
+    """
+    A map of the languages (a GeoDataFrame of points), coloured by labels
+    if given. The background is 'raster' or 'vector', as in draw_world.
+    Returns the axes.
+    """
+    fig, ax = plt.subplots(figsize=(16, 10))
+    draw_world(ax, background)
+    draw_points(ax, points, labels)
+    return ax
+
+
+def plot_many(points, label_sets, ncols=3, panel_size=(8, 5), legend=False, background='raster'):
+    """
+    Small multiples: a map of the languages for each set of labels, all
+    in one figure.
+
+    Parameters:
+    - points: The languages, as a GeoDataFrame of points
+    - label_sets: A mapping from titles to labels (e.g. a table with a
+      column per clustering cut, like the result of clustering.cuts)
+    - ncols: The number of maps per row
+    - panel_size: The size of each map in inches
+    - legend: Whether to give each map a legend
+    - background: 'raster' or 'vector', as in draw_world
+
+    Returns the figure.
+    """
+    titles = list(label_sets.keys())
+    nrows = max(1, -(-len(titles) // ncols))
+    fig, axes = plt.subplots(
+        nrows, ncols, figsize=(panel_size[0] * ncols, panel_size[1] * nrows), squeeze=False
+    )
+    for ax in axes.ravel()[len(titles):]:
+        ax.axis('off')
+    # A background about as wide as each map, so the coastlines stay unbroken
+    width = int(panel_size[0] * fig.dpi * 0.8) // 64 * 64
+    for ax, title in zip(axes.ravel(), titles):
+        draw_world(ax, background, width)
+        draw_points(ax, points, label_sets[title], legend=legend)
+        ax.set_title(str(title))
+    return fig
+
+
+def save_sequence(points, label_sets, path_pattern='map_{index:03d}.png', dpi=100):
+    """
+    Save a map of the languages for each set of labels as a sequence of
+    PNG files.
+
+    Only one figure is drawn; each frame just recolours its points and
+    swaps its legend and title.
+
+    Parameters:
+    - points: The languages, as a GeoDataFrame of points
+    - label_sets: A mapping from titles to labels
+    - path_pattern: The path of each file, formatted with its index and title
+    - dpi: The resolution of the files
+
+    Returns the paths of the files.
+    """
+    fig, ax = plt.subplots(figsize=(16, 10))
+    paths = []
+    try:
+        draw_background(ax)
+        scatter = draw_points(ax, points, legend=False)
+        for index, title in enumerate(label_sets.keys()):
+            categories, palette, point_colors = label_colors(label_sets[title])
+            scatter.set_facecolors(point_colors)
+            scatter.set_edgecolors(point_colors)
+            ax.legend(handles=legend_handles(categories, palette), loc='lower left')
+            ax.set_title(str(title))
+            path = path_pattern.format(index=index, title=title)
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fig.savefig(path, dpi=dpi)
+            paths.append(path)
+    finally:
+        plt.close(fig)
+    return paths
+
+
+def __getattr__(name):
+    if name == 'world':
+        return world_layer()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -3,17 +3,32 @@ Tools for modelling features based on language family and geographical area.
 """
 
 import math
+import os
 import textwrap
 
 import numpy as np
 import pandas as pd
 
-from sklearn import preprocessing as pre, pipeline
+from sklearn import preprocessing as pre
 from sklearn import model_selection as ms, metrics
 from sklearn import linear_model as lm
 
+import cache
+import parallel
 import walsdata
 
+# Bump this whenever a change to the models would make cached results stale
+results_version = 1
+
+# How much disk the cached model results may take up
+results_cache_bytes = 64 << 20
+
+# The inverse regularization strengths tried when cross-validating logistic models
+logistic_Cs = [0.2, 0.3, 0.5, 0.8, 1, 1.5, 2]
+
+# The regularization strengths tried when cross-validating linear models
+ridge_alphas = (0.01, 0.1, 1, 10, 100)
+
 
 class OriginDataset:
     """
@@ -28,6 +43,17 @@ class OriginDataset:
     - categories (list of lists): The list of acceptable family/region
       categories in each column of origins
     - random_state: The random state to use for the train-test split
+
+    The origins are one-hot encoded once, into the sparse design
+    matrices design_train, design_test and design (for all languages),
+    which every model shares. The cross-validation folds are also only
+    computed once: ridge_folds for the linear models, and per feature
+    (see logistic_folds) for the logistic models.
+
+    The tables from full_logistic_model, batched_logistic_model and
+    full_linear_model are cached on disk, keyed on the contents of
+    values, origins and categories, the split's random state, and the
+    model's parameters, so repeating a run just loads its table.
     """
     def __init__(self, values, origins, categories, random_state=5312):
         self.values = values.reindex(origins.index)
@@ -38,45 +64,66 @@ class OriginDataset:
             ms.train_test_split(self.values, self.origins, random_state=random_state)
         )
 
-    def origins_onehot(self, clf):
+        self.cache_key = cache.key_of(
+            cache.frame_hash(self.values),
+            cache.frame_hash(self.origins),
+            [list(col_cat) for col_cat in categories],
+            random_state,
+        )
+
         onehot = pre.OneHotEncoder(
             categories=self.categories,
             handle_unknown='ignore',
-        )
+        ).fit(self.origins_train)
+        self.design_train = onehot.transform(self.origins_train).tocsr()
+        self.design_test = onehot.transform(self.origins_test).tocsr()
+        self.design = onehot.transform(self.origins).tocsr()
 
-        model = pipeline.Pipeline([
-            ('onehot', onehot),
-            ('clf', clf),
-        ])
-        return model
+        # The positions of the training and testing languages in origins
+        self.train_rows = self.origins.index.get_indexer(self.origins_train.index)
+        self.test_rows = self.origins.index.get_indexer(self.origins_test.index)
+
+        # RidgeCV's default 5 folds
+        self.ridge_folds = list(ms.KFold(5).split(self.design_train))
+        self._logistic_folds = {}
+
+    def logistic_folds(self, feature):
+        """
+        LogisticRegressionCV's default stratified 5 folds of the training
+        set for this feature, computed the first time they're needed.
+
+        Raises ValueError if the feature can't be split into 5 folds.
+        """
+        if feature not in self._logistic_folds:
+            train = round_to_int(self.values_train[feature])
+            self._logistic_folds[feature] = list(
+                ms.StratifiedKFold(5).split(self.design_train, train)
+            )
+        return self._logistic_folds[feature]
     
     def logistic_model(self, feature, cv=False, random_state=5364):
         """
         Logistic regression on one feature
         """
         if cv:
-            logreg = lm.LogisticRegressionCV(
+            clf = lm.LogisticRegressionCV(
                 random_state=random_state, scoring='neg_log_loss',
-                Cs=[0.2, 0.3, 0.5, 0.8, 1, 1.5, 2]
+                Cs=logistic_Cs, cv=self.logistic_folds(feature),
             )
         else:
-            logreg = lm.LogisticRegression(random_state=random_state)
-        
-        model = self.origins_onehot(logreg)
+            clf = lm.LogisticRegression(random_state=random_state)
         
         train = round_to_int(self.values_train[feature])
         test = round_to_int(self.values_test[feature])
         full = round_to_int(self.values[feature])
         
-        model.fit(self.origins_train, train)
-
-        clf = model.named_steps['clf']
+        clf.fit(self.design_train, train)
 
         train_score = log_odds_vs_baseline(
-            train, model.predict_proba(self.origins_train)
+            train, clf.predict_proba(self.design_train)
         )
         test_score = log_odds_vs_baseline(
-            test, model.predict_proba(self.origins_test)
+            test, clf.predict_proba(self.design_test)
         )
         coefs = clf.coef_
         neutral_prob = clf.predict_proba(np.full(clf.coef_.shape, 0.0))[0, 1]
@@ -96,70 +143,632 @@ class OriginDataset:
 
         return result
     
-    def full_logistic_model(self, cv=False, random_state=5364):
+    def full_logistic_model(self, cv=False, random_state=5364, max_workers=1, use_cache=True):
+        """
+        Logistic regression on every one-hot feature
+
+        Parameters:
+        - cv: Whether to choose the regularization strength by cross-validation
+        - random_state: The random state to give each model
+        - max_workers: The number of worker processes to fit the features
+          in (None means one per CPU). The result is the same whatever
+          the number of workers.
+        - use_cache: Whether to load the table from the on-disk cache if
+          it's there, and save it there if it isn't
+        """
+        return self._cached_results(
+            ('full_logistic_model', cv, random_state, logistic_Cs if cv else None),
+            lambda: self._full_logistic_model(cv, random_state, max_workers),
+            use_cache,
+        )
+
+    def _full_logistic_model(self, cv, random_state, max_workers):
         cat_features = list(self.values.columns[self.values.columns.str.contains('_')])
-        result = []
-        for feature in cat_features:
-            try:
-                result.append(
-                    (feature, self.logistic_model(feature, cv=cv, random_state=random_state))
-                )
-            except ValueError:
-                # Feature missing from the training set
-                pass
-        return pandify(result)
+        chunk_size = len(cat_features)
+        if max_workers != 1:
+            # Several chunks per worker, so one slow chunk doesn't hold up the rest
+            n_chunks = 4 * (max_workers or os.cpu_count() or 1)
+            chunk_size = -(-len(cat_features) // n_chunks)
+        chunk_results = parallel.map_chunks(
+            _fit_logistic_models,
+            cat_features,
+            max(1, chunk_size),
+            max_workers,
+            args=(self, cv, random_state),
+        )
+        return pandify([item for chunk_result in chunk_results for item in chunk_result])
     
-    def full_linear_model(self, cv=False, random_state=5364):
+    def batched_logistic_model(self, cv=False, use_cache=True):
+        """
+        Logistic regression on every one-hot feature, fitting all the
+        features at once.
+
+        Gives the same table as full_logistic_model (up to the tolerance
+        of sklearn's solver), skipping the same features, but solves
+        every feature's regression together against the shared one-hot
+        design matrix with a vectorised Newton method.
+
+        Parameters:
+        - cv: Whether to choose each feature's regularization strength
+          from logistic_Cs by stratified 5-fold cross-validation, as
+          LogisticRegressionCV does
+        - use_cache: Whether to load the table from the on-disk cache if
+          it's there, and save it there if it isn't
+        """
+        return self._cached_results(
+            ('batched_logistic_model', cv, logistic_Cs if cv else None),
+            lambda: self._batched_logistic_model(cv),
+            use_cache,
+        )
+
+    def _batched_logistic_model(self, cv):
+        if cv:
+            return self.logistic_path().frame()
+        features, train, test, observed_probs, _ = self._logistic_targets(cv=False)
+        coefs = fit_logistic_batch(self.design_train.toarray(), train, 1.0)
+        return self._logistic_results(features, train, test, observed_probs, coefs).frame()
+
+    def logistic_path(self, Cs=logistic_Cs):
+        """
+        Logistic regression on every one-hot feature along a path of
+        regularization strengths.
+
+        Walks Cs in order, fitting every feature's training set and
+        cross-validation folds at each C, starting from the coefficients
+        found at the previous C. Each feature's result is for the C with
+        the best total cross-validated score, as LogisticRegressionCV
+        would choose it, and its path attribute has a table, indexed by
+        C, of the scores, innate rate and coefficients at every C. The
+        fold columns are each fold's negative log loss.
+
+        Returns an OriginResultsTable, whose frame is the same table as
+        batched_logistic_model(cv=True).
+
+        Parameters:
+        - Cs: The inverse regularization strengths, in the order to walk them
+        """
+        features, train, test, observed_probs, folds = self._logistic_targets(cv=True)
+        x_train = self.design_train.toarray()
+        x_test = self.design_test.toarray()
+        fold_scores, path_coefs = logistic_cv_path(x_train, train, folds, Cs)
+
+        best = fold_scores.sum(axis=2).argmax(axis=0)
+        coefs = path_coefs[best, np.arange(len(features))]
+
+        path_train_scores = np.array([
+            batch_log_odds_vs_baseline(train, predict_logistic_batch(x_train, c))
+            for c in path_coefs
+        ])
+        path_test_scores = np.array([
+            batch_log_odds_vs_baseline(test, predict_logistic_batch(x_test, c))
+            for c in path_coefs
+        ])
+        paths = [
+            self._path_table(
+                pd.Index(Cs, name='C'),
+                path_train_scores[:, j],
+                path_test_scores[:, j],
+                fold_scores[:, j],
+                expit(path_coefs[:, j, -1]),
+                path_coefs[:, j, :-1],
+            )
+            for j in range(len(features))
+        ]
+        return self._logistic_results(
+            features, train, test, observed_probs, coefs, paths
+        )
+
+    def permutation_test(
+        self,
+        n_permutations=1000,
+        cv=False,
+        Cs=logistic_Cs,
+        random_state=None,
+        max_workers=1,
+        chunk_size=25,
+    ):
+        """
+        Compare the logistic models of the one-hot features against
+        models fit to shuffled origins.
+
+        Each permutation shuffles every column of origins independently,
+        like the scrambled baseline in origins.ipynb, and fits every
+        feature at once with the batched solver. Since the one-hot
+        categories are fixed, shuffling a column of origins just shuffles
+        the rows of its block of the design matrix, so nothing is
+        re-encoded.
+
+        Parameters:
+        - n_permutations: The number of shuffles
+        - cv: Whether to choose each model's C by cross-validation over Cs
+          (about ten times slower)
+        - Cs: The inverse regularization strengths to try if cv is true
+        - random_state: Seed for the shuffles (see parallel.seeded_map_chunks)
+        - max_workers: The number of worker processes (None means one per CPU)
+        - chunk_size: The number of permutations each worker task runs
+        """
+        # Shuffling origins changes neither the targets nor the folds, so
+        # they, and the dense design, are made once for every permutation
+        design = self.design.toarray()
+        targets = self._logistic_targets(cv)
+        null = list(parallel.seeded_map_chunks(
+            _permutation_chunk,
+            n_permutations,
+            chunk_size,
+            random_state,
+            max_workers,
+            args=(self, design, targets, Cs),
+        ))
+        null_test_scores = np.concatenate([chunk[0] for chunk in null])
+        null_log_odds_shifts = np.concatenate([chunk[1] for chunk in null])
+
+        features, test_scores, log_odds_shifts = self._logistic_statistics(design, targets, Cs)
+        return PermutationTest(
+            [walsdata.get_shortname(feature) for feature in features],
+            test_scores,
+            log_odds_shifts,
+            null_test_scores,
+            null_log_odds_shifts,
+        )
+
+    def _logistic_statistics(self, design, targets, Cs):
+        """
+        The testing score and log odds shift of every one-hot feature's
+        logistic model, fit against the given dense design matrix for all
+        of origins. The targets are as made by _logistic_targets; if they
+        have folds, each model's C is chosen from Cs by cross-validation.
+        """
+        features, train, test, observed_probs, folds = targets
+        x_train = design[self.train_rows]
+        x_test = design[self.test_rows]
+        if folds is not None:
+            fold_scores, path_coefs = logistic_cv_path(x_train, train, folds, Cs)
+            best = fold_scores.sum(axis=2).argmax(axis=0)
+            coefs = path_coefs[best, np.arange(len(features))]
+        else:
+            coefs = fit_logistic_batch(x_train, train, 1.0)
+        test_scores = batch_log_odds_vs_baseline(test, predict_logistic_batch(x_test, coefs))
+        log_odds_shifts = np.log(odds_shift(expit(coefs[:, -1]), observed_probs))
+        return features, test_scores, log_odds_shifts
+
+    def category_blocks(self):
+        """The slice of design columns encoding each column of origins"""
+        ends = np.cumsum([len(col_cat) for col_cat in self.categories])
+        return [slice(end - len(col_cat), end) for col_cat, end in zip(self.categories, ends)]
+
+    def _logistic_targets(self, cv):
+        """
+        The one-hot features sklearn can fit, with their 0/1 training and
+        testing targets, observed rates and (if cv) fold test masks
+        """
+        cat_features = list(self.values.columns[self.values.columns.str.contains('_')])
+        train = np.round(self.values_train[cat_features].to_numpy()).astype(int)
+        test = np.round(self.values_test[cat_features].to_numpy()).astype(int)
+        full = np.round(self.values[cat_features].to_numpy()).astype(int)
+
+        # sklearn raises ValueError on these features, so they're skipped
+        keep = has_both_classes(train) & has_both_classes(test)
+        folds = None
+        if cv:
+            folds = [
+                self.logistic_test_masks(feature, train[:, i]) if keep[i] else None
+                for i, feature in enumerate(cat_features)
+            ]
+            keep &= np.array([fold_masks is not None for fold_masks in folds])
+            folds = [folds[i] for i in np.flatnonzero(keep)]
+        kept = np.flatnonzero(keep)
+        return (
+            [cat_features[i] for i in kept],
+            train[:, kept],
+            test[:, kept],
+            (full[:, kept] == 1).mean(axis=0),
+            folds,
+        )
+
+    def _logistic_results(self, features, train, test, observed_probs, coefs, paths=None):
+        train_scores = batch_log_odds_vs_baseline(
+            train, predict_logistic_batch(self.design_train.toarray(), coefs)
+        )
+        test_scores = batch_log_odds_vs_baseline(
+            test, predict_logistic_batch(self.design_test.toarray(), coefs)
+        )
+        return self.results_table(
+            features,
+            train_scores,
+            test_scores,
+            observed_probs,
+            expit(coefs[:, -1]),
+            coefs[:, :-1],
+            paths,
+        )
+
+    def _path_table(self, index, train_scores, test_scores, fold_scores, innate, coefs):
+        path = pd.DataFrame(index=index)
+        path['training_score'] = train_scores
+        path['testing_score'] = test_scores
+        path['cv_score'] = fold_scores.mean(axis=1)
+        for k in range(fold_scores.shape[1]):
+            path[f'fold_{k + 1}'] = fold_scores[:, k]
+        path['innate_rate'] = innate
+        names, positions = self.coef_columns()
+        return pd.concat(
+            [path, pd.DataFrame(coefs[:, positions], index=index, columns=names)],
+            axis=1,
+        )
+
+    def logistic_test_masks(self, feature, train):
+        """
+        The test-set masks of this feature's logistic folds, or None if
+        some test set would only contain one class (in which case scoring
+        it with log loss raises ValueError) or there are no folds.
+        """
+        try:
+            folds = self.logistic_folds(feature)
+        except ValueError:
+            return None
+        masks = np.zeros((len(folds), len(train)), dtype=bool)
+        for k, (_, test_rows) in enumerate(folds):
+            masks[k, test_rows] = True
+            if train[test_rows].min() == train[test_rows].max():
+                return None
+        return masks
+
+    def full_linear_model(self, cv=False, random_state=5364, use_cache=True):
+        """
+        Ridge regression on every ordinal feature
+
+        Parameters:
+        - cv: Whether to choose the regularization strength by cross-validation
+        - random_state: The random state to give the model
+        - use_cache: Whether to load the table from the on-disk cache if
+          it's there, and save it there if it isn't
+        """
+        return self._cached_results(
+            ('full_linear_model', cv, random_state, ridge_alphas if cv else None),
+            lambda: self._full_linear_model(cv, random_state),
+            use_cache,
+        )
+
+    def _full_linear_model(self, cv, random_state):
         ord_features = list(self.values.columns[~self.values.columns.str.contains('_')])
         
         if cv:
-            linreg = lm.RidgeCV(
-                cv=5,
-                alphas=(0.01, 0.1, 1, 10, 100)
+            clf = lm.RidgeCV(
+                cv=self.ridge_folds,
+                alphas=ridge_alphas,
             )
         else:
-            linreg = lm.Ridge(random_state=random_state)
-
-        model = self.origins_onehot(linreg)
+            clf = lm.Ridge(random_state=random_state)
 
         train = self.values_train[ord_features]
         test = self.values_test[ord_features]
         full = self.values[ord_features]
 
-        model.fit(self.origins_train, train)
-
-        clf = model.named_steps['clf']
+        clf.fit(self.design_train, train)
 
         train_score = metrics.r2_score(
-            train, model.predict(self.origins_train), multioutput='raw_values'
+            train, clf.predict(self.design_train), multioutput='raw_values'
         )
         test_score = metrics.r2_score(
-            test, model.predict(self.origins_test), multioutput='raw_values'
+            test, clf.predict(self.design_test), multioutput='raw_values'
         )
-        coefs = clf.coef_
         neutral_value = clf.predict(np.full((1, clf.coef_.shape[1]), 0.0))
         observed_value = full.mean().values
         
-        result = []
-        for i, feature in enumerate(ord_features):
-            result.append((
-                feature,
-                OriginResults(
-                    feature_name=walsdata.get_shortname(feature),
-                    train_score=train_score[i],
-                    test_score=test_score[i],
-                    observed_prob=observed_value[i],
-                    innate_prob=neutral_value[0, i],
-                    coefs=self.named_coefs(clf.coef_[i]),
-                )
-            ))
-        return pandify(result)
+        return self.results_table(
+            ord_features,
+            train_score,
+            test_score,
+            observed_value,
+            neutral_value[0],
+            clf.coef_,
+        ).frame()
     
+    def linear_path(self, alphas=ridge_alphas):
+        """
+        Ridge regression on every ordinal feature along a path of
+        regularization strengths.
+
+        The training set and each of ridge_folds are decomposed once, so
+        every alpha after the first costs almost nothing. As RidgeCV
+        does, one alpha is chosen for all the features, the one with the
+        best mean R^2 over the folds (averaged over the features). Each
+        feature's path attribute has a table, indexed by alpha, of the
+        scores, innate value and coefficients at every alpha. The fold
+        columns are each fold's R^2 for that feature.
+
+        Returns an OriginResultsTable, whose frame is the same table as
+        full_linear_model(cv=True) (up to the tolerance of sklearn's
+        solver).
+
+        Parameters:
+        - alphas: The regularization strengths to try
+        """
+        ord_features = list(self.values.columns[~self.values.columns.str.contains('_')])
+        x_train = self.design_train.toarray()
+        x_test = self.design_test.toarray()
+        train = self.values_train[ord_features].to_numpy()
+        test = self.values_test[ord_features].to_numpy()
+        observed_values = self.values[ord_features].mean().to_numpy()
+
+        path_coefs = ridge_path(x_train, train, alphas)
+        fold_scores = np.empty((len(alphas), len(ord_features), len(self.ridge_folds)))
+        for k, (train_rows, test_rows) in enumerate(self.ridge_folds):
+            fold_coefs = ridge_path(x_train[train_rows], train[train_rows], alphas)
+            for a, c in enumerate(fold_coefs):
+                fold_scores[a, :, k] = metrics.r2_score(
+                    train[test_rows], predict_linear_batch(x_train[test_rows], c),
+                    multioutput='raw_values',
+                )
+        best = fold_scores.mean(axis=(1, 2)).argmax()
+
+        path_train_scores = np.array([
+            metrics.r2_score(train, predict_linear_batch(x_train, c), multioutput='raw_values')
+            for c in path_coefs
+        ])
+        path_test_scores = np.array([
+            metrics.r2_score(test, predict_linear_batch(x_test, c), multioutput='raw_values')
+            for c in path_coefs
+        ])
+
+        paths = [
+            self._path_table(
+                pd.Index(alphas, name='alpha'),
+                path_train_scores[:, j],
+                path_test_scores[:, j],
+                fold_scores[:, j],
+                path_coefs[:, j, -1],
+                path_coefs[:, j, :-1],
+            )
+            for j in range(len(ord_features))
+        ]
+        return self.results_table(
+            ord_features,
+            path_train_scores[best],
+            path_test_scores[best],
+            observed_values,
+            path_coefs[best, :, -1],
+            path_coefs[best, :, :-1],
+            paths,
+        )
+
+    def _cached_results(self, model_key, build, use_cache):
+        if not use_cache:
+            return build()
+        key = cache.key_of(results_version, self.cache_key, model_key)
+        return cache.load_or_build('origins', key, build, max_bytes=results_cache_bytes)
+
     def named_coefs(self, coefs):
         return dict(
             zip((cat for col_cat in self.categories for cat in col_cat), coefs)
         )
 
+    def coef_columns(self):
+        """
+        The names of the coefficients, and the design column each one
+        comes from, as named_coefs pairs them up (a category appearing
+        in more than one column of origins is named once, for its last
+        column)
+        """
+        positions = {}
+        for i, cat in enumerate(cat for col_cat in self.categories for cat in col_cat):
+            positions[cat] = i
+        return list(positions), np.array(list(positions.values()), dtype=np.intp)
+
+    def results_table(
+        self,
+        features,
+        train_scores,
+        test_scores,
+        observed_probs,
+        innate_probs,
+        coefs,
+        paths=None,
+    ):
+        """
+        An OriginResultsTable of models of the given features, with one
+        row of coefficients (over all the design columns) per feature
+        """
+        names, positions = self.coef_columns()
+        return OriginResultsTable(
+            [walsdata.get_shortname(feature) for feature in features],
+            train_scores,
+            test_scores,
+            observed_probs,
+            innate_probs,
+            np.asarray(coefs)[:, positions],
+            names,
+            paths,
+        )
+
+
+def _fit_logistic_models(features, dataset, cv, random_state):
+    result = []
+    for feature in features:
+        try:
+            result.append(
+                (feature, dataset.logistic_model(feature, cv=cv, random_state=random_state))
+            )
+        except ValueError:
+            # Feature missing from the training set
+            pass
+    return result
+
+
+def _permutation_chunk(seeds, dataset, design, targets, Cs):
+    shuffled = np.empty_like(design)
+    blocks = dataset.category_blocks()
+    test_scores = []
+    log_odds_shifts = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        for block in blocks:
+            shuffled[:, block] = design[rng.permutation(len(design)), block]
+        _, test_score, log_odds_shift = dataset._logistic_statistics(shuffled, targets, Cs)
+        test_scores.append(test_score)
+        log_odds_shifts.append(log_odds_shift)
+    return np.array(test_scores), np.array(log_odds_shifts)
+
+
+def has_both_classes(y):
+    """Whether each column of a 0/1 matrix contains both classes"""
+    return (y.min(axis=0) == 0) & (y.max(axis=0) == 1)
+
+
+def logistic_cv_path(x, y, folds, Cs):
+    """
+    Fit logistic regressions to every target, and every fold of every
+    target, along a path of Cs.
+
+    All the fits for one C are done at once, starting from the
+    coefficients found at the previous C.
+
+    Parameters:
+    - x: The design matrix
+    - y: The 0/1 targets, one per column
+    - folds (list of arrays): For each target, the test-set mask of
+      each fold
+    - Cs: The inverse regularization strengths, in the order to walk them
+
+    Returns each fold's negative log loss, indexed by C, target and fold,
+    and the coefficients fitted to the whole of each target's data,
+    indexed by C and target.
+    """
+    n_targets = y.shape[1]
+    n_folds = len(folds[0])
+    test_masks = np.concatenate(folds).T
+    # The fold fits, target by target, then the full fits
+    path_y = np.hstack([np.repeat(y, n_folds, axis=1), y])
+    weights = np.hstack([~test_masks, np.ones(y.shape, dtype=bool)])
+    n_fold_fits = n_targets * n_folds
+
+    fold_scores = np.empty((len(Cs), n_targets, n_folds))
+    path_coefs = np.empty((len(Cs), n_targets, x.shape[1] + 1))
+    coefs = None
+    for c, C in enumerate(Cs):
+        coefs = fit_logistic_batch(x, path_y, C, weights=weights, coefs=coefs)
+        fold_coefs = coefs[:n_fold_fits]
+        losses = batch_log_loss(
+            path_y[:, :n_fold_fits], predict_logistic_batch(x, fold_coefs), weights=test_masks
+        )
+        fold_scores[c] = -losses.reshape(n_targets, n_folds)
+        path_coefs[c] = coefs[n_fold_fits:]
+    return fold_scores, path_coefs
+
+
+def fit_logistic_batch(x, y, C, weights=None, coefs=None, tol=1e-8, max_iter=100):
+    """
+    Fit an L2-regularized logistic regression to each column of y at once.
+
+    Minimizes the same objective as sklearn's LogisticRegression: C times
+    the total log loss plus half the squared norm of the coefficients,
+    with an unpenalized intercept. Uses Newton's method, halving the step
+    for any target whose objective would go up.
+
+    Parameters:
+    - x: The design matrix shared by every target
+    - y: The 0/1 targets, one per column
+    - C: The inverse regularization strength, one for all targets or one each
+    - weights: Optional 0/1 weights selecting each target's training rows
+    - coefs: Optional starting coefficients
+
+    Returns an array with one row of coefficients per target, the
+    intercept last.
+    """
+    design = np.hstack([x, np.ones((len(x), 1))])
+    n_targets = y.shape[1]
+    n_coefs = design.shape[1]
+    # Each row's products of pairs of columns, so every target's Hessian
+    # comes out of one matrix product
+    pairs = (design[:, :, None] * design[:, None, :]).reshape(len(design), -1)
+    y = y.astype(float)
+    weights = np.ones(y.shape) if weights is None else weights.astype(float)
+    C = np.broadcast_to(np.asarray(C, dtype=float), (n_targets,))
+    penalty = np.ones(n_coefs)
+    penalty[-1] = 0
+    if coefs is None:
+        coefs = np.zeros((n_targets, n_coefs))
+
+    def objective(coefs):
+        z = design @ coefs.T
+        losses = (weights * (np.logaddexp(0, z) - y * z)).sum(axis=0)
+        return C * losses + 0.5 * (penalty * coefs ** 2).sum(axis=1)
+
+    current = objective(coefs)
+    for _ in range(max_iter):
+        prob = expit(design @ coefs.T)
+        gradient = C[:, None] * (design.T @ (weights * (prob - y))).T + penalty * coefs
+        curvature = C[:, None] * (weights * prob * (1 - prob)).T
+        hessian = (curvature @ pairs).reshape(n_targets, n_coefs, n_coefs)
+        hessian += np.diag(penalty)
+        step = np.linalg.solve(hessian, gradient[:, :, None])[:, :, 0]
+        scale = np.ones(n_targets)
+        for _ in range(30):
+            new = objective(coefs - scale[:, None] * step)
+            worse = new > current + 1e-12 * np.abs(current)
+            if not worse.any():
+                break
+            scale[worse] /= 2
+        coefs = coefs - scale[:, None] * step
+        current = new
+        if np.abs(scale[:, None] * step).max() < tol:
+            break
+    return coefs
+
+
+def predict_logistic_batch(x, coefs):
+    """Each target's probability of a 1 on each row of x"""
+    return expit(x @ coefs[:, :-1].T + coefs[:, -1])
+
+
+def ridge_path(x, y, alphas):
+    """
+    Fit a ridge regression to each column of y for each alpha.
+
+    Solves the same problem as sklearn's Ridge, with an unpenalized
+    intercept, exactly: the centred design matrix is decomposed once
+    and every alpha reuses the decomposition.
+
+    Returns the coefficients indexed by alpha and target, the intercept last.
+    """
+    x_mean = x.mean(axis=0)
+    y_mean = y.mean(axis=0)
+    u, singular, vt = np.linalg.svd(x - x_mean, full_matrices=False)
+    projected = u.T @ (y - y_mean)
+    coefs = np.empty((len(alphas), y.shape[1], x.shape[1] + 1))
+    for a, alpha in enumerate(alphas):
+        weights = vt.T @ ((singular / (singular ** 2 + alpha))[:, None] * projected)
+        coefs[a, :, :-1] = weights.T
+        coefs[a, :, -1] = y_mean - x_mean @ weights
+    return coefs
+
+
+def predict_linear_batch(x, coefs):
+    """Each target's predicted value on each row of x"""
+    return x @ coefs[:, :-1].T + coefs[:, -1]
+
+
+def expit(z):
+    return 1 / (1 + np.exp(-z))
+
+
+def batch_log_loss(y, prob, weights=None, eps=1e-15):
+    """
+    The mean log loss of each column of probabilities, clipped as
+    sklearn's log_loss clips them
+    """
+    prob = np.clip(prob, eps, 1 - eps)
+    losses = -(y * np.log(prob) + (1 - y) * np.log(1 - prob))
+    if weights is None:
+        return losses.mean(axis=0)
+    return (weights * losses).sum(axis=0) / weights.sum(axis=0)
+
+
+def batch_log_odds_vs_baseline(y_true, y_pred):
+    """log_odds_vs_baseline for each column of targets and probabilities"""
+    baseline = np.broadcast_to(y_true.mean(axis=0), y_true.shape)
+    return 1 - batch_log_loss(y_true, y_pred) / batch_log_loss(y_true, baseline)
+
 
 def round_to_int(series):
     """
@@ -189,17 +798,10 @@ def log_odds_vs_baseline(y_true, y_pred):
 
 
 def pandify(origin_results):
-    features, origin_results = zip(*origin_results)
-    df = pd.DataFrame(index=map(walsdata.get_shortname, features))
-    df['training_score'] = [result.train_score for result in origin_results]
-    df['testing_score'] = [result.test_score for result in origin_results]
-    df['observed_rate'] = [result.observed_prob for result in origin_results]
-    df['innate_rate'] = [result.innate_prob for result in origin_results]
-    df['odds_shift'] = odds_shift(df['innate_rate'], df['observed_rate'])
-    df['log_odds_shift'] = np.log(df['odds_shift'])
-    for coef in origin_results[0].coefs:
-        df[coef] = [result.coefs[coef] for result in origin_results]
-    return df
+    """
+    The table of a list of (feature, OriginResults) pairs
+    """
+    return OriginResultsTable.from_results(origin_results).frame()
 
 
 def odds_shift(p0, p):
@@ -210,7 +812,209 @@ def odds(p):
     return p / (1 - p)
 
 
+class PermutationTest:
+    """
+    The results of OriginDataset.permutation_test.
+
+    Attributes:
+    - observed: Each feature's testing score and log odds shift with the
+      real origins
+    - null_testing_score, null_log_odds_shift: The same statistics for
+      each permutation (rows) and feature (columns)
+    - p_values: For each feature, the fraction of permutations scoring
+      at least as well as the real origins (counting the real origins
+      as one of the permutations), and the fraction shifting the log
+      odds at least as far in either direction
+    """
+    def __init__(
+        self,
+        features,
+        test_scores,
+        log_odds_shifts,
+        null_test_scores,
+        null_log_odds_shifts,
+    ):
+        self.observed = pd.DataFrame(
+            {'testing_score': test_scores, 'log_odds_shift': log_odds_shifts},
+            index=features,
+        )
+        self.null_testing_score = pd.DataFrame(null_test_scores, columns=features)
+        self.null_testing_score.index.name = 'permutation'
+        self.null_log_odds_shift = pd.DataFrame(null_log_odds_shifts, columns=features)
+        self.null_log_odds_shift.index.name = 'permutation'
+
+        n_permutations = len(null_test_scores)
+        self.p_values = pd.DataFrame(index=features)
+        self.p_values['testing_score'] = (
+            1 + (null_test_scores >= test_scores).sum(axis=0)
+        ) / (n_permutations + 1)
+        self.p_values['log_odds_shift'] = (
+            1 + (np.abs(null_log_odds_shifts) >= np.abs(log_odds_shifts)).sum(axis=0)
+        ) / (n_permutations + 1)
+
+
+class OriginResultsTable:
+    """
+    The results of origin models of many features, stored by column.
+
+    All the numbers are in one contiguous array, data, with a row per
+    feature and a column for each of stat_columns followed by one per
+    coefficient. The statistics (train_scores, test_scores,
+    observed_probs, innate_probs, odds_shifts and log_odds_shifts) and
+    coefs are views into it, frame() is a DataFrame over it without a
+    copy, and indexing gives the OriginResults of one feature.
+
+    Parameters:
+    - feature_names: The short name of each feature
+    - train_scores, test_scores, observed_probs, innate_probs: One
+      value per feature
+    - coefs: A matrix of coefficients, with a row per feature
+    - coef_names: The name of each column of coefs
+    - paths: Optionally, each feature's regularization path table
+    """
+    stat_columns = [
+        'training_score',
+        'testing_score',
+        'observed_rate',
+        'innate_rate',
+        'odds_shift',
+        'log_odds_shift',
+    ]
+
+    def __init__(
+        self,
+        feature_names,
+        train_scores,
+        test_scores,
+        observed_probs,
+        innate_probs,
+        coefs,
+        coef_names,
+        paths=None,
+    ):
+        data = np.empty((len(feature_names), len(self.stat_columns) + len(coef_names)))
+        data[:, 0] = train_scores
+        data[:, 1] = test_scores
+        data[:, 2] = observed_probs
+        data[:, 3] = innate_probs
+        data[:, 4] = odds_shift(data[:, 3], data[:, 2])
+        data[:, 5] = np.log(data[:, 4])
+        data[:, len(self.stat_columns):] = coefs
+        self._init(feature_names, data, coef_names, paths)
+
+    def _init(self, feature_names, data, coef_names, paths):
+        self.feature_names = list(feature_names)
+        self.data = data
+        self.coef_names = list(coef_names)
+        self.paths = paths
+
+    @classmethod
+    def from_results(cls, origin_results):
+        """The table of a list of (feature, OriginResults) pairs"""
+        features, origin_results = zip(*origin_results)
+        coef_names = list(origin_results[0].coefs)
+        return cls(
+            [walsdata.get_shortname(feature) for feature in features],
+            [result.train_score for result in origin_results],
+            [result.test_score for result in origin_results],
+            [result.observed_prob for result in origin_results],
+            [result.innate_prob for result in origin_results],
+            [[result.coefs[coef] for coef in coef_names] for result in origin_results],
+            coef_names,
+            None if origin_results[0].path is None else [
+                result.path for result in origin_results
+            ],
+        )
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Stack the rows of several tables, which must have the same coefficients
+        """
+        coef_names = tables[0].coef_names
+        for table in tables[1:]:
+            if table.coef_names != coef_names:
+                raise ValueError('Tables have different coefficients')
+        if all(table.paths is not None for table in tables):
+            paths = [path for table in tables for path in table.paths]
+        else:
+            paths = None
+        result = cls.__new__(cls)
+        result._init(
+            [name for table in tables for name in table.feature_names],
+            np.concatenate([table.data for table in tables]),
+            coef_names,
+            paths,
+        )
+        return result
+
+    @property
+    def train_scores(self):
+        return self.data[:, 0]
+
+    @property
+    def test_scores(self):
+        return self.data[:, 1]
+
+    @property
+    def observed_probs(self):
+        return self.data[:, 2]
+
+    @property
+    def innate_probs(self):
+        return self.data[:, 3]
+
+    @property
+    def odds_shifts(self):
+        return self.data[:, 4]
+
+    @property
+    def log_odds_shifts(self):
+        return self.data[:, 5]
+
+    @property
+    def coefs(self):
+        return self.data[:, len(self.stat_columns):]
+
+    def frame(self):
+        """A DataFrame of the table, sharing its data"""
+        return pd.DataFrame(
+            self.data,
+            index=pd.Index(self.feature_names, dtype=object),
+            columns=pd.Index(self.stat_columns + self.coef_names, dtype=object),
+            copy=False,
+        )
+
+    def __len__(self):
+        return len(self.feature_names)
+
+    def __getitem__(self, i):
+        row = self.data[i]
+        return OriginResults(
+            feature_name=self.feature_names[i],
+            train_score=row[0],
+            test_score=row[1],
+            observed_prob=row[2],
+            innate_prob=row[3],
+            coefs=dict(zip(self.coef_names, row[len(self.stat_columns):])),
+            path=None if self.paths is None else self.paths[i],
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 class OriginResults:
+    __slots__ = (
+        'feature_name',
+        'train_score',
+        'test_score',
+        'observed_prob',
+        'innate_prob',
+        'coefs',
+        'path',
+    )
+
     def __init__(
         self,
         feature_name,
@@ -219,6 +1023,7 @@ class OriginResults:
         observed_prob,
         innate_prob,
         coefs,
+        path=None,
     ):
         self.feature_name = feature_name
         self.train_score = train_score
@@ -226,6 +1031,8 @@ class OriginResults:
         self.observed_prob = observed_prob
         self.innate_prob = innate_prob
         self.coefs = coefs
+        # The results along a regularization path, if the model was fit along one
+        self.path = path
     
     def __str__(self):
         max_coef_name_len = max(len(coef_name) for coef_name in self.coefs)
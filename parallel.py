@@ -0,0 +1,47 @@
+"""
+Tools for spreading independent pieces of work over worker processes
+
+Work is split into chunks, and each chunk is handled by one call of a
+module-level function, so a worker process gets a few large tasks
+rather than many small ones. With max_workers=1 the chunks run in this
+process, with no pool at all.
+"""
+
+import itertools
+from concurrent import futures
+
+import numpy as np
+
+
+def map_chunks(function, items, chunk_size, max_workers=1, args=()):
+    """
+    Call function(chunk, *args) on each chunk of chunk_size items, and
+    yield the results in order as they arrive.
+
+    Parameters:
+    - function: A module-level function, so it can be sent to workers
+    - items: The items to split into chunks
+    - chunk_size: The number of items per call
+    - max_workers: The number of worker processes (None means one per CPU)
+    - args: Further arguments, the same for every call
+    """
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if max_workers == 1:
+        for chunk in chunks:
+            yield function(chunk, *args)
+        return
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(function, chunks, *(itertools.repeat(arg) for arg in args))
+
+
+def seeded_map_chunks(function, n_items, chunk_size, random_state=None, max_workers=1, args=()):
+    """
+    map_chunks over n_items random seeds, each a child of random_state.
+
+    The function is given a chunk of SeedSequences and should use one per
+    item (e.g. one per shuffle or per bootstrap round). Since every item
+    has its own seed, the results don't depend on max_workers or
+    chunk_size.
+    """
+    seeds = np.random.SeedSequence(random_state).spawn(n_items)
+    return map_chunks(function, seeds, chunk_size, max_workers, args)
@@ -0,0 +1,249 @@
+"""
+Fast fuzzy search for WALS languages by name or code
+
+The index covers each language's name, its alternate names from
+language_names.csv, its WALS ID, Glottocode and ISO 639-3 code. Names
+are normalised (case, accents and punctuation are ignored), then found
+by exact match, by prefix of the whole name or of any word in it
+(binary search over the sorted keys, which serves as a prefix trie),
+and, failing those, by the trigrams they share with the query. The
+index is built once and saved in the cache, keyed on the source tables.
+"""
+
+import bisect
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+import cache
+import store
+
+# Bump this whenever a change to LanguageIndex would make saved indexes stale
+index_version = 1
+
+# How similar (in shared trigrams) a name must be to count as a fuzzy match
+min_similarity = 0.4
+
+_index = None
+
+
+def normalise(text):
+    """Lowercase text, with accents, punctuation and extra spaces removed"""
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
+
+def trigrams(key):
+    """The distinct trigrams of a normalised key, padded to mark the ends of words"""
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LanguageIndex:
+    """
+    A search index over the names and codes of the WALS languages.
+
+    Parameters:
+    - langs: The languages table
+    - names: The alternate names table, whose Language_ID may list
+      several WALS IDs separated by spaces
+    """
+    # Score bonuses for each kind of match; within a kind, matches are
+    # ranked by trigram similarity, which is at most 1
+    exact_score = 3.0
+    prefix_score = 2.0
+    word_prefix_score = 1.0
+    primary_bonus = 0.5
+
+    def __init__(self, langs, names):
+        self.ids = langs.ID.to_numpy(dtype=object)
+        self.names = langs.Name.to_numpy(dtype=object)
+        positions = pd.Index(self.ids)
+
+        entry_keys = []
+        entry_langs = []
+        entry_primary = []
+
+        def add(texts, lang_positions, primary):
+            for text, position in zip(texts, lang_positions):
+                key = normalise(text)
+                if key and position >= 0:
+                    entry_keys.append(key)
+                    entry_langs.append(position)
+                    entry_primary.append(primary)
+
+        everyone = np.arange(len(self.ids))
+        add(langs.Name, everyone, True)
+        for column in ['ID', 'Glottocode', 'ISO639P3code']:
+            known = langs[column].notna().to_numpy()
+            add(langs[column][known], everyone[known], True)
+        alternate_ids = names.Language_ID.astype(str).str.split()
+        repeats = alternate_ids.str.len().to_numpy()
+        add(
+            np.repeat(names.Name.to_numpy(dtype=object), repeats),
+            positions.get_indexer(np.concatenate(alternate_ids.to_numpy())),
+            False,
+        )
+        self.entry_keys = np.array(entry_keys, dtype=object)
+        self.entry_langs = np.array(entry_langs, dtype=np.intp)
+        self.entry_primary = np.array(entry_primary)
+
+        # Every entry under its whole key and under each word onwards,
+        # sorted, so a prefix is a contiguous range
+        prefixes = []
+        for entry, key in enumerate(entry_keys):
+            prefixes.append((key, entry, True))
+            starts = [match.start() for match in re.finditer(' ', key)]
+            prefixes.extend((key[start + 1:], entry, False) for start in starts)
+        prefixes.sort()
+        self.prefix_keys = [key for key, _, _ in prefixes]
+        self.prefix_entries = np.array([entry for _, entry, _ in prefixes], dtype=np.intp)
+        self.prefix_whole = np.array([whole for _, _, whole in prefixes])
+
+        postings = {}
+        self.trigram_counts = np.empty(len(entry_keys), dtype=np.int32)
+        for entry, key in enumerate(entry_keys):
+            grams = trigrams(key)
+            self.trigram_counts[entry] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(entry)
+        self.postings = {
+            gram: np.array(entries, dtype=np.intp) for gram, entries in postings.items()
+        }
+
+    def scores(self, query, mask=None):
+        """
+        The score of every language for a query, 0 for no match.
+
+        Parameters:
+        - query: The name or code to search for
+        - mask: If given, a boolean array saying which languages to consider
+        """
+        key = normalise(query)
+        result = np.zeros(len(self.ids))
+        if not key:
+            return result
+        n_entries = len(self.entry_keys)
+
+        grams = trigrams(key)
+        found = [self.postings[gram] for gram in grams if gram in self.postings]
+        shared = np.bincount(
+            np.concatenate(found) if found else np.empty(0, dtype=np.intp),
+            minlength=n_entries,
+        )
+        entry_scores = 2 * shared / (len(grams) + self.trigram_counts)
+        entry_scores[entry_scores < min_similarity] = 0
+
+        start = bisect.bisect_left(self.prefix_keys, key)
+        end = bisect.bisect_left(self.prefix_keys, key + '\uffff', lo=start)
+        if end > start:
+            entries = self.prefix_entries[start:end]
+            whole = self.prefix_whole[start:end]
+            bonus = np.where(whole, self.prefix_score, self.word_prefix_score)
+            exact = whole & (self.entry_keys[entries] == key)
+            bonus[exact] = self.exact_score
+            best = np.zeros(n_entries)
+            np.maximum.at(best, entries, bonus)
+            entry_scores += best
+
+        matched = np.flatnonzero(entry_scores)
+        entry_scores[matched] += self.primary_bonus * self.entry_primary[matched]
+        np.maximum.at(result, self.entry_langs[matched], entry_scores[matched])
+        if mask is not None:
+            result[~mask] = 0
+        return result
+
+    def mask(self, among):
+        """Which languages are among the given IDs, or the languages of a Sample"""
+        if among is None:
+            return None
+        if hasattr(among, 'langs_list'):
+            among = among.langs_list
+        return pd.Index(self.ids).isin(list(among))
+
+    def search(self, query, limit=10, among=None):
+        """
+        The languages best matching a name or code, best first.
+
+        Parameters:
+        - query: The name or code to search for
+        - limit: The most languages to return
+        - among: Only consider these language IDs, or the languages of
+          this Sample
+
+        Returns a table of the matching languages' IDs, names and scores.
+        """
+        scores = self.scores(query, self.mask(among))
+        matched = self._ranked(scores, limit)
+        return pd.DataFrame({
+            'ID': self.ids[matched],
+            'Name': self.names[matched],
+            'Score': scores[matched],
+        })
+
+    def search_many(self, queries, limit=1, among=None):
+        """
+        Search for many names at once; see search.
+
+        Returns a table with a row per match, giving the query it matched.
+        """
+        mask = self.mask(among)
+        queries = list(queries)
+        matches = []
+        match_scores = []
+        for query in queries:
+            scores = self.scores(query, mask)
+            matched = self._ranked(scores, limit)
+            matches.append(matched)
+            match_scores.append(scores[matched])
+        matched = np.concatenate(matches) if matches else np.empty(0, dtype=np.intp)
+        return pd.DataFrame({
+            'Query': np.repeat(np.array(queries, dtype=object), [len(m) for m in matches]),
+            'ID': self.ids[matched],
+            'Name': self.names[matched],
+            'Score': np.concatenate(match_scores) if matches else np.empty(0),
+        })
+
+    def lookup(self, queries, among=None):
+        """
+        The ID of the best matching language for each query, as a series
+        indexed by query (missing where nothing matched)
+        """
+        mask = self.mask(among)
+        result = []
+        for query in queries:
+            scores = self.scores(query, mask)
+            best = scores.argmax()
+            result.append(self.ids[best] if scores[best] > 0 else None)
+        return pd.Series(result, index=pd.Index(queries, name='Query'), name='ID')
+
+    def _ranked(self, scores, limit):
+        """The positions of the best scoring languages, best first; ties go to the shorter name"""
+        matched = np.flatnonzero(scores)
+        name_lengths = np.array([len(name) for name in self.names[matched]], dtype=int)
+        return matched[np.lexsort((name_lengths, -scores[matched]))][:limit]
+
+
+def index():
+    """The search index over all the WALS languages, built the first time it's needed"""
+    global _index
+    if _index is None:
+        key = cache.key_of(
+            index_version, store.source_hash('languages'), store.source_hash('language_names')
+        )
+        _index = cache.load_or_build(
+            'search',
+            key,
+            lambda: LanguageIndex(
+                store.load_table('languages'), store.load_table('language_names')
+            ),
+        )
+    return _index
+
+
+def search(query, limit=10, among=None):
+    """The languages best matching a name or code; see LanguageIndex.search"""
+    return index().search(query, limit, among)
@@ -0,0 +1,188 @@
+"""
+Great-circle distances between all the WALS languages
+
+The full matrix of distances (in km, as float32) is computed once and
+saved in the cache, keyed on the languages table. Loading memory-maps
+it, so every process using it shares the same pages instead of
+computing its own distances. Radius and nearest-neighbour queries are
+answered from the matrix, a batch of rows at a time.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+import store
+import walsdata
+
+# Bump this whenever a change to the computation would make saved matrices stale
+spatial_version = 1
+
+earth_radius_km = 6371.0
+
+# How many rows of the matrix are computed or scanned at once
+block_rows = 256
+
+_matrix = None
+_index = None
+
+
+def spatial_dir():
+    return os.path.join(cache.cache_dir, 'spatial')
+
+
+def index():
+    """The language IDs labelling the rows and columns of the matrix"""
+    global _index
+    if _index is None:
+        _index = pd.Index(walsdata.langs.ID)
+    return _index
+
+
+def distance_matrix():
+    """
+    The read-only, memory-mapped matrix of great-circle distances in km
+    between all the WALS languages, in the order of walsdata.langs.
+    """
+    global _matrix
+    if _matrix is None:
+        key = cache.key_of(spatial_version, store.source_hash('languages'))
+        path = os.path.join(spatial_dir(), f'{key}.npy')
+        if not os.path.exists(path):
+            build(path)
+        _matrix = np.load(path, mmap_mode='r')
+    return _matrix
+
+
+def build(path):
+    """Compute the distance matrix into a .npy file at path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    points = np.radians(walsdata.langs[['Latitude', 'Longitude']].to_numpy(dtype=float))
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    matrix = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32, shape=(len(points), len(points))
+    )
+    for start in range(0, len(points), block_rows):
+        matrix[start:start + block_rows] = haversine_km(points[start:start + block_rows], points)
+    matrix.flush()
+    del matrix
+    os.replace(tmp_path, path)
+
+
+def haversine_km(a, b):
+    """
+    The great-circle distances in km from each of the points a to each
+    of the points b, both given as (latitude, longitude) in radians
+    """
+    lat_a, lon_a = a[:, :1], a[:, 1:]
+    lat_b, lon_b = b[:, 0], b[:, 1]
+    h = (
+        np.sin((lat_b - lat_a) / 2) ** 2
+        + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    )
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def positions(ids):
+    """The rows of the matrix of the given language IDs"""
+    result = index().get_indexer(ids)
+    if (result < 0).any():
+        missing = np.asarray(ids, dtype=object)[result < 0]
+        raise KeyError(f'Unknown languages: {list(missing)}')
+    return result
+
+
+def distances(ids, among=None):
+    """
+    The distances in km from each of the languages ids to each of the
+    languages among (by default, all of them), as a table
+    """
+    columns = index() if among is None else pd.Index(among)
+    rows = positions(ids)
+    cols = slice(None) if among is None else positions(among)
+    return pd.DataFrame(
+        np.asarray(distance_matrix()[rows][:, cols]),
+        index=pd.Index(ids, name='Language_ID'),
+        columns=columns,
+    )
+
+
+def within(ids, radius, among=None, return_distance=False):
+    """
+    For each of the languages ids, the languages within radius km of
+    it, nearest first. The language itself is included, at distance 0.
+
+    Parameters:
+    - ids: The language IDs to query
+    - radius: The radius in km
+    - among: Only return these languages (by default, any language)
+    - return_distance: Also return the distances
+
+    Returns a list with an array of language IDs for each query, and if
+    return_distance is true, a matching list of arrays of distances.
+    """
+    candidates = index() if among is None else pd.Index(among)
+    cols = None if among is None else positions(among)
+    neighbours = []
+    neighbour_distances = []
+    for block, block_distances in _blocks(ids, cols):
+        for row in block_distances:
+            found = np.flatnonzero(row <= radius)
+            found = found[np.argsort(row[found], kind='stable')]
+            neighbours.append(candidates[found].to_numpy())
+            neighbour_distances.append(row[found])
+    if return_distance:
+        return neighbours, neighbour_distances
+    return neighbours
+
+
+def nearest(ids, k, among=None):
+    """
+    The k nearest other languages to each of the languages ids.
+
+    Parameters:
+    - ids: The language IDs to query
+    - k: The number of neighbours
+    - among: Only consider these languages (by default, any language)
+
+    Returns a table of neighbour IDs and a table of their distances in
+    km, each with a row per query and columns 1 to k, nearest first.
+    Ties are broken in favour of the earlier language.
+    """
+    candidates = index() if among is None else pd.Index(among)
+    cols = None if among is None else positions(among)
+    query_positions = positions(ids)
+    candidate_positions = np.arange(len(index())) if cols is None else cols
+    neighbours = np.empty((len(query_positions), k), dtype=np.intp)
+    neighbour_distances = np.empty((len(query_positions), k), dtype=np.float32)
+    start = 0
+    for block, block_distances in _blocks(ids, cols):
+        block_distances = np.array(block_distances)
+        # A language isn't its own neighbour
+        is_self = candidate_positions[None, :] == block[:, None]
+        block_distances[is_self] = np.inf
+        order = np.argsort(block_distances, axis=1, kind='stable')[:, :k]
+        end = start + len(block)
+        neighbours[start:end] = order
+        neighbour_distances[start:end] = np.take_along_axis(block_distances, order, axis=1)
+        start = end
+    columns = pd.RangeIndex(1, k + 1)
+    query_index = pd.Index(ids, name='Language_ID')
+    return (
+        pd.DataFrame(candidates.to_numpy()[neighbours], index=query_index, columns=columns),
+        pd.DataFrame(neighbour_distances, index=query_index, columns=columns),
+    )
+
+
+def _blocks(ids, cols):
+    """The query rows a block at a time, with their distances to the columns cols"""
+    matrix = distance_matrix()
+    rows = positions(ids)
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        block_distances = matrix[block]
+        if cols is not None:
+            block_distances = block_distances[:, cols]
+        yield block, block_distances
@@ -0,0 +1,179 @@
+"""
+Binary columnar store for the WALS CLDF tables
+
+Each table is converted once from its CSV into one .npy file per column,
+plus a manifest recording the hash of the source CSV. String columns are
+stored as integer codes into a table of categories; everything else is
+stored as a plain array. Loading reads the arrays straight into
+ordinary, writable memory with no parsing, so it costs very little, and
+the table is only converted again when its CSV changes.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+tables = {
+    'languages': 'data/languages.csv',
+    'parameters': 'data/parameters.csv',
+    'values': 'data/values.csv',
+    'codes': 'data/codes.csv',
+    'language_names': 'data/language_names.csv',
+}
+
+# Bump this whenever a change to the conversion would make stored tables stale
+store_version = 1
+
+
+def store_dir():
+    return os.path.join(cache.cache_dir, 'store')
+
+
+def load_table(name):
+    """
+    Load one of the WALS tables, converting it from CSV first if needed.
+
+    Reference columns (those ending in _ID) are loaded as categoricals
+    backed by the stored integer codes; other string columns are decoded
+    to ordinary object columns.
+    """
+    manifest = fresh_manifest(name)
+    table_dir = os.path.join(store_dir(), name)
+    columns = {}
+    for column in manifest['columns']:
+        path = os.path.join(table_dir, column['file'])
+        data = np.load(path)
+        if column['kind'] == 'categorical':
+            categories = pd.Index(
+                np.load(os.path.join(table_dir, column['categories_file'])),
+                dtype=object,
+            )
+            data = pd.Categorical.from_codes(data, categories=categories)
+            if not column['name'].endswith('_ID'):
+                data = np.asarray(data, dtype=object)
+        columns[column['name']] = data
+    return pd.DataFrame(columns, copy=False)
+
+
+def source_hash(name):
+    """The hash of the CSV a table was converted from"""
+    return fresh_manifest(name)['sha256']
+
+
+def fresh_manifest(name):
+    """
+    The manifest of a stored table, converting the table first if it
+    hasn't been converted yet or its CSV has changed since.
+    """
+    source = tables[name]
+    manifest_path = os.path.join(store_dir(), name, 'manifest.json')
+    stat = os.stat(source)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return convert(name)
+    if manifest.get('version') != store_version:
+        return convert(name)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return manifest
+    # The file was touched; only reconvert if its contents really changed
+    sha256 = cache.file_hash(source)
+    if sha256 != manifest['sha256']:
+        return convert(name)
+    manifest['size'] = stat.st_size
+    manifest['mtime_ns'] = stat.st_mtime_ns
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def convert(name):
+    """Convert a table from its CSV into the binary store, returning its manifest"""
+    source = tables[name]
+    stat = os.stat(source)
+    sha256 = cache.file_hash(source)
+    df = pd.read_csv(source)
+
+    table_dir = os.path.join(store_dir(), name)
+    os.makedirs(table_dir, exist_ok=True)
+    columns = []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        file = f'{i}.npy'
+        if series.dtype == object:
+            categorical = pd.Categorical(series)
+            np.save(os.path.join(table_dir, file), np.asarray(categorical.codes))
+            categories_file = f'{i}.categories.npy'
+            np.save(
+                os.path.join(table_dir, categories_file),
+                np.asarray(categorical.categories, dtype=str),
+            )
+            columns.append({
+                'name': col,
+                'kind': 'categorical',
+                'file': file,
+                'categories_file': categories_file,
+            })
+        else:
+            np.save(os.path.join(table_dir, file), series.to_numpy())
+            columns.append({'name': col, 'kind': 'array', 'file': file})
+
+    manifest = {
+        'version': store_version,
+        'source': source,
+        'sha256': sha256,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'rows': len(df),
+        'columns': columns,
+    }
+    write_manifest(os.path.join(table_dir, 'manifest.json'), manifest)
+    return manifest
+
+
+def write_manifest(path, manifest):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def code_positions(categorical, labels):
+    """
+    For each category of a categorical series, its position in labels,
+    or -1 if it isn't one of the labels.
+
+    Indexing the result with the series' codes maps every row straight
+    to a position, so filtering and cross-tabulating on the categorical
+    only ever compares integers.
+    """
+    categories = categorical.cat.categories
+    positions = np.full(len(categories) + 1, -1)
+    indexer = categories.get_indexer(labels)
+    found = indexer >= 0
+    positions[indexer[found]] = np.arange(len(labels))[found]
+    # The last slot catches the -1 code of missing values
+    return positions
+
+
+def code_crosstab(row_positions, col_positions, shape, values=None):
+    """
+    Sum values (or count rows) into a matrix of the given shape.
+
+    Rows with a negative row or column position are ignored. Returns the
+    matrix of sums and the matrix of counts.
+    """
+    row_positions = np.asarray(row_positions, dtype=np.intp)
+    col_positions = np.asarray(col_positions, dtype=np.intp)
+    keep = (row_positions >= 0) & (col_positions >= 0)
+    flat = row_positions[keep] * shape[1] + col_positions[keep]
+    size = shape[0] * shape[1]
+    counts = np.bincount(flat, minlength=size).reshape(shape)
+    if values is None:
+        return counts, counts
+    sums = np.bincount(flat, weights=values[keep], minlength=size).reshape(shape)
+    return sums, counts
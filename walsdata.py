@@ -2,23 +2,58 @@
 Representations of WALS data and samples from it
 """
 
+import copy
+import itertools
+import pickle
+
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+from scipy import sparse
 from sklearn import base, pipeline, preprocessing as pre
-from sklearn.impute import KNNImputer
 
-langs = pd.read_csv('data/languages.csv')
+import cache
+import impute
+import parallel
+import search
+import store
+
+data_tables = ['languages', 'parameters', 'values', 'codes']
+
+# Bump this whenever a change to Sample would make cached samples stale
+sample_version = 5
+
+# Features recoverable from others (see Sample.drop_redundant)
+redundant_features = ['95A', '96A', '97A', '143E', '143F']
+
+langs = store.load_table('languages')
 langs_geo = gpd.GeoDataFrame(
     langs.copy(), geometry=gpd.points_from_xy(langs.Longitude, langs.Latitude)
 )
 
-features = pd.read_csv('data/parameters.csv')
+features = store.load_table('parameters')
 
-values = pd.read_csv('data/values.csv')
-present_values = pd.crosstab(values.Language_ID, values.Parameter_ID)
+values = store.load_table('values')
 
-codes = pd.read_csv('data/codes.csv')
+
+def _present_values():
+    language_ids = values.Language_ID.cat.categories
+    parameter_ids = values.Parameter_ID.cat.categories
+    counts, _ = store.code_crosstab(
+        np.asarray(values.Language_ID.cat.codes),
+        np.asarray(values.Parameter_ID.cat.codes),
+        (len(language_ids), len(parameter_ids)),
+    )
+    return pd.DataFrame(
+        counts,
+        index=pd.Index(language_ids, name='Language_ID'),
+        columns=pd.Index(parameter_ids, name='Parameter_ID'),
+    )
+
+
+present_values = _present_values()
+
+codes = store.load_table('codes')
 
 
 def density(df):
@@ -28,23 +63,141 @@ def density(df):
 def choose_features_and_languages(
     df, density_threshold, n_features_to_drop, n_languages_to_drop, verbose=True
 ):
-    df_sub = df.copy()
-    i = 1
-    while density(df_sub) < density_threshold:
-        features_sub = df_sub.sum().sort_values(ascending=False)
-        features_to_drop = features_sub[
-            features_sub <= features_sub[-n_features_to_drop]
-        ].index
-        languages_sub = df_sub.sum(axis=1).sort_values(ascending=False)
-        languages_to_drop = languages_sub[
-            languages_sub <= languages_sub[-n_languages_to_drop]
-        ].index
-        df_sub.drop(features_to_drop, axis=1, inplace=True)
-        df_sub.drop(languages_to_drop, inplace=True)
-        if verbose and (i % 5 == 0 or density(df_sub) >= density_threshold):
-            print(f'Iteration {i}: reached density {density(df_sub):.1%}')
-        i += 1
-    return df_sub
+    trajectory = prune_features_and_languages(
+        df, n_features_to_drop, n_languages_to_drop, density_threshold=density_threshold
+    )
+    if verbose:
+        for i, step in trajectory.steps.iloc[1:].iterrows():
+            if i % 5 == 0 or step.density >= density_threshold:
+                print(f'Iteration {i}: reached density {step.density:.1%}')
+    return trajectory.at_step(trajectory.steps.index[-1])
+
+
+def prune_features_and_languages(
+    df, n_features_to_drop, n_languages_to_drop, density_threshold=1.0
+):
+    """
+    Iteratively drop the worst-covered features and languages from a table
+    of present values, recording the whole pruning trajectory.
+
+    Each iteration drops every feature covered no better than the
+    n_features_to_drop-th worst feature, and every language covered no
+    better than the n_languages_to_drop-th worst language. This continues
+    until the density reaches density_threshold (by default, until the
+    table is completely filled in), so any lower threshold can be read
+    off the same trajectory.
+
+    Rather than re-summing the table each iteration, this keeps the
+    coverage of every row and column and subtracts the cells of the
+    dropped rows and columns from it.
+    """
+    matrix = np.nan_to_num(df.to_numpy(dtype=float))
+    counted = df.notna().to_numpy()
+    n_languages, n_features = matrix.shape
+
+    language_sums = matrix.sum(axis=1)
+    language_counts = counted.sum(axis=1)
+    feature_sums = matrix.sum(axis=0)
+    feature_counts = counted.sum(axis=0)
+    language_dropped_at = np.full(n_languages, np.iinfo(int).max)
+    feature_dropped_at = np.full(n_features, np.iinfo(int).max)
+    languages_kept = np.arange(n_languages)
+    features_kept = np.arange(n_features)
+
+    total = language_sums.sum()
+    total_count = language_counts.sum()
+    steps = [(n_languages, n_features, total / total_count)]
+    step = 0
+    while total_count > 0 and total / total_count < density_threshold:
+        step += 1
+        features_to_drop = worst_covered(
+            features_kept, feature_sums, n_features_to_drop
+        )
+        languages_to_drop = worst_covered(
+            languages_kept, language_sums, n_languages_to_drop
+        )
+        features_kept = np.setdiff1d(features_kept, features_to_drop)
+        languages_kept = np.setdiff1d(languages_kept, languages_to_drop)
+        feature_dropped_at[features_to_drop] = step
+        language_dropped_at[languages_to_drop] = step
+
+        language_sums[languages_kept] -= matrix[
+            np.ix_(languages_kept, features_to_drop)
+        ].sum(axis=1)
+        language_counts[languages_kept] -= counted[
+            np.ix_(languages_kept, features_to_drop)
+        ].sum(axis=1)
+        feature_sums[features_kept] -= matrix[
+            np.ix_(languages_to_drop, features_kept)
+        ].sum(axis=0)
+        feature_counts[features_kept] -= counted[
+            np.ix_(languages_to_drop, features_kept)
+        ].sum(axis=0)
+
+        total = language_sums[languages_kept].sum()
+        total_count = language_counts[languages_kept].sum()
+        steps.append((
+            len(languages_kept),
+            len(features_kept),
+            total / total_count if total_count > 0 else np.nan,
+        ))
+
+    return PruningTrajectory(
+        df,
+        pd.DataFrame(
+            steps,
+            columns=['languages', 'features', 'density'],
+            index=pd.RangeIndex(len(steps), name='step'),
+        ),
+        language_dropped_at,
+        feature_dropped_at,
+    )
+
+
+def worst_covered(kept, sums, n):
+    """The kept rows or columns covered no better than the n-th worst one"""
+    kept_sums = sums[kept]
+    if n >= len(kept):
+        return kept
+    cutoff = np.partition(kept_sums, n - 1)[n - 1]
+    return kept[kept_sums <= cutoff]
+
+
+class PruningTrajectory:
+    """
+    The tables kept at every iteration of prune_features_and_languages.
+    
+    Attributes:
+    - steps: A table of the number of languages and features kept, and the
+      resulting density, after each iteration (iteration 0 being the
+      starting table)
+    """
+    def __init__(self, df, steps, language_dropped_at, feature_dropped_at):
+        self.df = df
+        self.steps = steps
+        self.language_dropped_at = language_dropped_at
+        self.feature_dropped_at = feature_dropped_at
+    
+    def at_step(self, step):
+        """The table kept after the given iteration"""
+        return self.df.iloc[
+            self.language_dropped_at > step,
+            self.feature_dropped_at > step,
+        ]
+    
+    def first_step_reaching(self, density_threshold):
+        """The first iteration whose table reaches the given density"""
+        reached = self.steps.index[self.steps.density >= density_threshold]
+        if len(reached) == 0:
+            raise ValueError(f'The density never reaches {density_threshold}')
+        return reached[0]
+    
+    def at_density(self, density_threshold):
+        """
+        The table kept once the given density is reached, i.e. what
+        choose_features_and_languages returns for this threshold
+        """
+        return self.at_step(self.first_step_reaching(density_threshold))
 
 
 def choose_and_evaluate_features_and_languages(df, *args, **kwargs):
@@ -70,6 +223,138 @@ def sort_highest_coverage_first(df):
 present_values_sorted = sort_highest_coverage_first(present_values)
 
 
+def search_pruning_schedules(
+    df=None,
+    n_features_to_drop_options=range(1, 4),
+    n_languages_to_drop_options=range(1, 11),
+    min_density=0.0,
+    max_workers=1,
+):
+    """
+    Prune the table with many drop schedules at once and keep the tables on
+    the Pareto frontier of languages kept, features kept, and density.
+
+    Every combination of n_features_to_drop and n_languages_to_drop is run
+    to completion, spread over max_workers processes with
+    parallel.map_chunks, and every iteration of every run is a candidate.
+    A candidate is on the frontier if no other candidate keeps at least as
+    many languages and features at at least the same density.
+
+    Parameters:
+    - df: The table of present values to prune (by default,
+      present_values_sorted)
+    - n_features_to_drop_options, n_languages_to_drop_options: The values
+      of each parameter to try
+    - min_density: Ignore candidates less dense than this
+    - max_workers: The number of worker processes (None means one per CPU)
+    """
+    if df is None:
+        df = present_values_sorted
+    schedules = list(
+        itertools.product(n_features_to_drop_options, n_languages_to_drop_options)
+    )
+    trajectories = [
+        trajectory
+        for chunk in parallel.map_chunks(
+            _prune_with_schedules, schedules, 1, max_workers, args=(df,)
+        )
+        for trajectory in chunk
+    ]
+    for trajectory in trajectories:
+        trajectory.df = df
+    return PruningFrontier(df, schedules, trajectories, min_density)
+
+
+def _prune_with_schedules(schedules, df):
+    trajectories = []
+    for n_features_to_drop, n_languages_to_drop in schedules:
+        trajectory = prune_features_and_languages(df, n_features_to_drop, n_languages_to_drop)
+        # The parent process already has the table, so don't send it back
+        trajectory.df = None
+        trajectories.append(trajectory)
+    return trajectories
+
+
+class PruningFrontier:
+    """
+    The Pareto-optimal tables found by search_pruning_schedules.
+    
+    Attributes:
+    - points: A table of the frontier, sorted by number of languages,
+      giving the languages and features kept, the density, the density of
+      the naive table with as many of the best-covered languages and
+      features, and the schedule and iteration that produced it
+    """
+    def __init__(self, df, schedules, trajectories, min_density=0.0):
+        self.df = df
+        self.trajectories = dict(zip(schedules, trajectories))
+        candidates = pd.concat(
+            [
+                trajectory.steps.reset_index().assign(
+                    n_features_to_drop=schedule[0],
+                    n_languages_to_drop=schedule[1],
+                )
+                for schedule, trajectory in self.trajectories.items()
+            ],
+            ignore_index=True,
+        )
+        candidates = candidates[
+            (candidates.density >= min_density) &
+            (candidates.languages > 0) &
+            (candidates.features > 0)
+        ]
+        candidates = candidates.drop_duplicates(['languages', 'features', 'density'])
+        points = candidates[pareto_optimal(
+            candidates[['languages', 'features', 'density']].to_numpy()
+        )]
+        points = points.sort_values(['languages', 'features']).reset_index(drop=True)
+        points['naive_density'] = naive_densities(
+            df, points.languages.to_numpy(), points.features.to_numpy()
+        )
+        self.points = points[[
+            'languages', 'features', 'density', 'naive_density',
+            'n_features_to_drop', 'n_languages_to_drop', 'step',
+        ]]
+    
+    def submatrix(self, i):
+        """The table kept at the i-th point of the frontier"""
+        point = self.points.loc[i]
+        schedule = (point.n_features_to_drop, point.n_languages_to_drop)
+        return self.trajectories[schedule].at_step(point.step)
+    
+    def submatrices(self):
+        return [self.submatrix(i) for i in self.points.index]
+
+
+def pareto_optimal(points, chunk_size=1024):
+    """
+    Which rows of a 2D array of points are not dominated by any other row,
+    i.e. no other row is at least as large in every column and larger in
+    at least one?
+    """
+    optimal = np.ones(len(points), dtype=bool)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size, np.newaxis, :]
+        at_least = (points[np.newaxis, :, :] >= chunk).all(axis=2)
+        larger = (points[np.newaxis, :, :] > chunk).any(axis=2)
+        optimal[start:start + chunk_size] = ~(at_least & larger).any(axis=1)
+    return optimal
+
+
+def naive_densities(df, n_languages, n_features):
+    """
+    The densities of df.iloc[:M, :N] for each pair of M and N, all read off
+    one table of cumulative sums
+    """
+    matrix = np.nan_to_num(df.to_numpy(dtype=float))
+    counted = df.notna().to_numpy()
+    sums = np.zeros((matrix.shape[0] + 1, matrix.shape[1] + 1))
+    sums[1:, 1:] = matrix.cumsum(axis=0).cumsum(axis=1)
+    counts = np.zeros(sums.shape)
+    counts[1:, 1:] = counted.cumsum(axis=0).cumsum(axis=1)
+    return sums[n_languages, n_features] / counts[n_languages, n_features]
+
+
 class Sample:
     def __init__(self, present_values, impute=False):
         self.present_values = present_values.sort_index()
@@ -77,55 +362,68 @@ class Sample:
         self.langs = langs_geo[langs_geo.ID.isin(self.langs_list)]
         self.lang_names = list(self.langs.Name)
         self.features_list = list(
-            sorted(
-                self.present_values.columns,
-                key=lambda x: (int(x[:-1]), x[-1:])
-            )
+            sorted(self.present_values.columns, key=feature_order)
         )
         self.features = features[features.ID.isin(self.features_list)]
         self.feature_names = list(self.features.Name)
-        self.values = values[
-            values.Language_ID.isin(self.langs.ID) &
-            values.Parameter_ID.isin(self.features.ID)
+        # Match IDs on their integer codes rather than comparing strings
+        lang_positions = store.code_positions(values.Language_ID, self.langs_list)[
+            values.Language_ID.cat.codes
+        ]
+        feature_positions = store.code_positions(values.Parameter_ID, self.features_list)[
+            values.Parameter_ID.cat.codes
         ]
+        in_sample = (lang_positions >= 0) & (feature_positions >= 0)
+        self.values = values[in_sample]
         self.codes = codes[
-            codes.Parameter_ID.isin(self.features.ID)
+            store.code_positions(codes.Parameter_ID, self.features_list)[
+                codes.Parameter_ID.cat.codes
+            ] >= 0
         ]
-        self.values_matrix = pd.crosstab(
-            self.values.Language_ID,
-            self.values.Parameter_ID,
-            values=self.values.Value,
-            aggfunc='sum',
-        ).fillna(-1).astype(int).reindex(
-            index=self.langs_list,
-            columns=self.features_list,
+        sums, counts = store.code_crosstab(
+            lang_positions,
+            feature_positions,
+            (len(self.langs_list), len(self.features_list)),
+            values=values.Value.to_numpy(),
+        )
+        self.values_matrix = pd.DataFrame(
+            np.where(counts > 0, sums, -1).astype(int),
+            index=pd.Index(self.langs_list, name='Language_ID'),
+            columns=pd.Index(self.features_list, name='Parameter_ID'),
         )
         if impute:
-            self.encoder = PandasColumnTransformer(feature_treatment)
-            self.values_encoded = self.encoder.fit_transform(self.values_matrix)
-            nunique = self.values_encoded.replace(-1, np.nan).nunique()
-            no_variation_cols = list(nunique[nunique == 1].index)
-            self.values_encoded = self.values_encoded.drop(no_variation_cols, axis=1)
-            
-            self.scaler = pipeline.Pipeline([
-                ('missing', pre.FunctionTransformer(to_float)),
-                ('scaler', pre.MinMaxScaler((0, 1))),
-            ])
-            self.values_scaled = pd.DataFrame(
-                self.scaler.fit_transform(self.values_encoded),
-                columns=self.values_encoded.columns,
-                index=self.values_encoded.index,
-            )
-            
-            self.imputer = KNNImputer(weights='distance')
-            self.values_scaled_imputed = pd.DataFrame(
-                self.imputer.fit_transform(self.values_scaled),
-                columns=self.values_encoded.columns,
-                index=self.values_encoded.index,
-            )
+            self.pipeline = EncodingPipeline().fit(self.values_matrix)
+            self.encoder = self.pipeline.encoder
+            self.values_encoded = self.pipeline.encode(self.values_matrix)
+            self.scaler = self.pipeline.scaler
+            self.values_scaled = self.pipeline.scale(self.values_encoded)
+            self.imputer = self.pipeline.imputer
+            self.values_scaled_imputed = self.pipeline.impute(self.values_scaled)
     
-    def search_language(self, name):
-        return self.langs[self.langs.Name.str.contains(name)][['ID', 'Name']]
+    def search_language(self, name, limit=10):
+        """
+        The languages of this sample best matching a name, alternate name
+        or code, best first
+        """
+        return search.search(name, limit, among=self.langs_list)[['ID', 'Name']]
+    
+    def multiple_imputations(self, n_imputations, random_state=None, max_workers=1):
+        """
+        Several stochastic versions of values_scaled_imputed, as an array of
+        shape (n_imputations, languages, feature columns).
+        
+        Each missing value is copied from one of the nearest languages
+        that has it, chosen with probability proportional to its weight in
+        the usual imputation, so iterating over the imputations shows how
+        much a result depends on the imputed values. The nearest languages
+        are only found once for all the imputations.
+        """
+        return self.imputer.sample(
+            self.values_scaled,
+            n_imputations,
+            random_state=random_state,
+            max_workers=max_workers,
+        )
     
     def fcount(self, feature_id):
         """How many languages in the sample have this feature defined?"""
@@ -151,21 +449,424 @@ class Sample:
         from the more comprehensive classification in 143A.
         """
         return Sample(
-            self.present_values.drop(['95A', '96A', '97A', '143E', '143F'], axis=1, errors='ignore'),
+            self.present_values.drop(redundant_features, axis=1, errors='ignore'),
             impute=True
         )
         
 
-def sample_of_density(density_threshold):
-    return Sample(
-        choose_and_evaluate_features_and_languages(
-            present_values,
-            density_threshold=density_threshold,
-            n_features_to_drop=1,
-            n_languages_to_drop=2,
-            verbose=False,
+class SparseSample:
+    """
+    A sample of any set of languages and features, stored sparsely.
+    
+    Unlike Sample, this doesn't assume the sample is mostly filled in, so
+    it can hold all of WALS. The values, which languages have which
+    features, and the encoded feature columns are all kept as scipy
+    sparse matrices, with missing values simply not stored (WALS value
+    codes start at 1, so a stored value is never 0). Nothing here ever
+    builds a dense language-by-feature matrix.
+    
+    Features without an entry in feature_treatment are fully one-hot
+    encoded, with one column per value in codes.csv.
+    
+    Parameters:
+    - langs_list: The IDs of the languages to include (by default, all of them)
+    - features_list: The IDs of the features to include (by default, all of them)
+    """
+    def __init__(self, langs_list=None, features_list=None):
+        if langs_list is None:
+            langs_list = list(values.Language_ID.cat.categories)
+        if features_list is None:
+            features_list = list(values.Parameter_ID.cat.categories)
+        self.langs_list = sorted(langs_list)
+        self.langs = langs_geo[langs_geo.ID.isin(self.langs_list)]
+        self.lang_names = list(self.langs.Name)
+        self.features_list = sorted(features_list, key=feature_order)
+        self.features = features[features.ID.isin(self.features_list)]
+        self.feature_names = list(self.features.Name)
+        
+        lang_positions = store.code_positions(values.Language_ID, self.langs_list)[
+            values.Language_ID.cat.codes
+        ]
+        feature_positions = store.code_positions(values.Parameter_ID, self.features_list)[
+            values.Parameter_ID.cat.codes
+        ]
+        in_sample = (lang_positions >= 0) & (feature_positions >= 0)
+        self.values = values[in_sample]
+        self.codes = codes[
+            store.code_positions(codes.Parameter_ID, self.features_list)[
+                codes.Parameter_ID.cat.codes
+            ] >= 0
+        ]
+        shape = (len(self.langs_list), len(self.features_list))
+        self.values_matrix = sparse.csr_matrix(
+            (
+                values.Value.to_numpy()[in_sample],
+                (lang_positions[in_sample], feature_positions[in_sample]),
+            ),
+            shape=shape,
+        )
+        self.present_values = sparse.csr_matrix(
+            (
+                np.ones(in_sample.sum(), dtype=int),
+                (lang_positions[in_sample], feature_positions[in_sample]),
+            ),
+            shape=shape,
+        )
+        self.feature_counts = pd.Series(
+            self.present_values.getnnz(axis=0), index=self.features_list
+        )
+        self._encode()
+    
+    def _encode(self):
+        n_values = self.codes.groupby('Parameter_ID', observed=True).Number.max()
+        by_feature = self.values_matrix.tocsc()
+        self.encoders = {}
+        self.encoded_columns = []
+        # Which encoded columns come from which feature
+        expansion_rows = []
+        blocks = []
+        for j, feature in enumerate(self.features_list):
+            if feature in feature_treatment:
+                encoder = copy.deepcopy(feature_treatment[feature])
+            else:
+                encoder = OneHot(int(n_values.get(feature, 0)))
+            encoder.fit(pd.DataFrame(columns=[feature]))
+            self.encoders[feature] = encoder
+            names = encoder.get_feature_names()
+            start = len(self.encoded_columns)
+            self.encoded_columns.extend(names)
+            expansion_rows.append(np.full(len(names), j))
+            
+            stored = slice(by_feature.indptr[j], by_feature.indptr[j + 1])
+            rows = by_feature.indices[stored]
+            block = encoder.lookup(by_feature.data[stored])
+            block_rows, block_cols = np.nonzero(block)
+            blocks.append((
+                block[block_rows, block_cols],
+                rows[block_rows],
+                start + block_cols,
+            ))
+        
+        data, rows, cols = (np.concatenate(parts) for parts in zip(*blocks))
+        self.values_encoded = sparse.csr_matrix(
+            (data, (rows, cols)),
+            shape=(len(self.langs_list), len(self.encoded_columns)),
+        )
+        expansion_rows = np.concatenate(expansion_rows)
+        self.expansion = sparse.csr_matrix(
+            (
+                np.ones(len(expansion_rows), dtype=int),
+                (expansion_rows, np.arange(len(expansion_rows))),
+            ),
+            shape=(len(self.features_list), len(self.encoded_columns)),
+        )
+    
+    def encoded_present(self):
+        """Which languages have a value in each encoded column"""
+        return self.present_values @ self.expansion
+    
+    def value_indicators(self):
+        """
+        A sparse matrix with a row per language and a column per value in
+        codes.csv, with a 1 where the language has that value, and a
+        table of the values labelling the columns (with the position of
+        each value's feature in features_list)
+        """
+        feature_positions = store.code_positions(self.codes.Parameter_ID, self.features_list)[
+            self.codes.Parameter_ID.cat.codes
+        ]
+        order = np.lexsort((self.codes.Number.to_numpy(), feature_positions))
+        value_codes = self.codes.iloc[order][['ID', 'Parameter_ID', 'Number', 'Name']].reset_index(
+            drop=True
+        )
+        value_codes['feature'] = feature_positions[order]
+        
+        # Look up each stored value's column by its feature and number
+        lookup = np.full((len(self.features_list), value_codes.Number.max() + 1), -1)
+        lookup[value_codes.feature, value_codes.Number] = np.arange(len(value_codes))
+        by_value = self.values_matrix.tocoo()
+        cols = lookup[by_value.col, by_value.data]
+        known = cols >= 0
+        indicators = sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=np.int32), (by_value.row[known], cols[known])),
+            shape=(len(self.langs_list), len(value_codes)),
+        )
+        return indicators, value_codes
+    
+    def fcount(self, feature_id):
+        """How many languages in the sample have this feature defined?"""
+        return self.feature_counts[feature_id]
+    
+    def value_names(self, feature_id):
+        """What do the numerical value codes represent?"""
+        return self.codes[self.codes.Parameter_ID == feature_id][['Name', 'Number']].set_index('Number')
+    
+    def to_frame(self, encoded=False):
+        """The values (or encoded values) as a pandas DataFrame with sparse columns"""
+        if encoded:
+            return pd.DataFrame.sparse.from_spmatrix(
+                self.values_encoded, index=self.langs_list, columns=self.encoded_columns,
+            )
+        return pd.DataFrame.sparse.from_spmatrix(
+            self.values_matrix, index=self.langs_list, columns=self.features_list,
+        )
+    
+    def save(self, path):
+        """
+        Save the sparse matrices and their labels to a .npz file.
+        
+        Missing values aren't stored, so the encoded values need the
+        matrix from encoded_present to tell missing values from zeros.
+        """
+        encoded_present = self.encoded_present().tocsr()
+        arrays = {
+            'langs_list': np.array(self.langs_list),
+            'features_list': np.array(self.features_list),
+            'encoded_columns': np.array(self.encoded_columns),
+        }
+        for name, matrix in [
+            ('values_matrix', self.values_matrix),
+            ('present_values', self.present_values),
+            ('values_encoded', self.values_encoded),
+            ('encoded_present', encoded_present),
+        ]:
+            arrays[f'{name}_data'] = matrix.data
+            arrays[f'{name}_indices'] = matrix.indices
+            arrays[f'{name}_indptr'] = matrix.indptr
+            arrays[f'{name}_shape'] = np.array(matrix.shape)
+        np.savez_compressed(path, **arrays)
+
+
+class Implications:
+    """
+    Implicational tendencies between WALS values, of the form "languages
+    with value A tend to have value B".
+    
+    Only observed values count: the probability of B given A is the
+    fraction of the languages with A, among those that have any value
+    for B's feature, that have B. All the counts come from three sparse
+    matrix products over indicator matrices:
+    - counts: For each pair of values, how many languages have both
+    - coverage: For each value and feature, how many languages with the
+      value have any value for the feature
+    - joint_coverage: For each pair of features, how many languages have
+      values for both
+    
+    Parameters:
+    - sample: The SparseSample to mine (by default, all of WALS)
+    """
+    # Left out of implications by default: the redundant features, and
+    # 81A, which crosses 82A with 83A, so it implies both by definition
+    default_exclude = redundant_features + ['81A']
+    
+    def __init__(self, sample=None):
+        if sample is None:
+            sample = SparseSample()
+        self.sample = sample
+        indicators, self.value_codes = sample.value_indicators()
+        present = sample.present_values.astype(np.int32)
+        self.counts = (indicators.T @ indicators).tocsr()
+        self.coverage = (indicators.T @ present).toarray()
+        self.joint_coverage = (present.T @ present).toarray()
+        
+        # The WALS chapter of each value's feature, e.g. '90' for 90C
+        feature_ids = self.value_codes.Parameter_ID.astype(str)
+        self.value_chapters = feature_ids.str.rstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ').to_numpy()
+        feature_names = sample.features.set_index('ID').Name
+        self.value_names = (
+            feature_names.reindex(self.value_codes.Parameter_ID).to_numpy(dtype=object)
+            + ': '
+            + self.value_codes.Name.to_numpy(dtype=object)
         )
+    
+    def top(
+        self,
+        k=50,
+        min_support=20,
+        min_probability=0.0,
+        min_lift=1.2,
+        by='probability',
+        exclude=None,
+        within_chapters=False,
+        block_size=256,
+    ):
+        """
+        The k strongest implications.
+        
+        Antecedents are scored a block at a time, keeping only the best k
+        implications seen so far, so the full table of pairs is never
+        built.
+        
+        Parameters:
+        - k: The number of implications to return
+        - min_support: Ignore implications resting on fewer languages
+          (with A and a value for B's feature) than this
+        - min_probability: Ignore implications with a lower P(B|A)
+        - min_lift: Ignore implications with a lower lift (see by), so
+          near-universal values B, which almost every A "implies", don't
+          crowd out the real implications
+        - by: Rank by 'probability', P(B|A), or by 'lift', P(B|A) over
+          the rate of B among languages with values for both features
+        - exclude: Feature IDs to leave out as antecedents and
+          consequents (by default, default_exclude; [] for none)
+        - within_chapters: Whether to include implications between
+          features of the same WALS chapter (e.g. 90A and 90C, or 143A
+          and 143G), which mostly classify the same data two ways
+        - block_size: The number of antecedents scored at once
+        
+        Returns a table of implications, strongest first. Ties are
+        broken in favour of the better-supported implication.
+        """
+        if by not in ('probability', 'lift'):
+            raise ValueError(f'Unknown ranking {by!r}')
+        if exclude is None:
+            exclude = self.default_exclude
+        value_features = self.value_codes.feature.to_numpy()
+        n_values = len(value_features)
+        included = ~self.value_codes.Parameter_ID.isin(exclude).to_numpy()
+        chapters = self.value_chapters
+        best_scores = np.empty(0)
+        best_supports = np.empty(0, dtype=int)
+        best_pairs = np.empty((0, 2), dtype=np.intp)
+        for start in range(0, n_values, block_size):
+            block = np.arange(start, min(start + block_size, n_values))
+            together = self.counts[block].toarray()
+            support = self.coverage[block][:, value_features]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                probability = together / support
+                lift = probability / self._baseline(block)
+            score = lift if by == 'lift' else probability
+            keep = (
+                (support >= max(min_support, 1))
+                & (probability >= min_probability)
+                & (lift >= min_lift)
+                & (value_features[block][:, None] != value_features[None, :])
+                & included[block][:, None]
+                & included[None, :]
+                & ~np.isnan(score)
+            )
+            if not within_chapters:
+                keep &= chapters[block][:, None] != chapters[None, :]
+            rows, cols = np.nonzero(keep)
+            best_scores = np.concatenate([best_scores, score[rows, cols]])
+            best_supports = np.concatenate([best_supports, support[rows, cols]])
+            best_pairs = np.concatenate([best_pairs, np.column_stack([block[rows], cols])])
+            chosen = np.lexsort((-best_supports, -best_scores))[:k]
+            best_scores = best_scores[chosen]
+            best_supports = best_supports[chosen]
+            best_pairs = best_pairs[chosen]
+        
+        return self._table(best_pairs[:, 0], best_pairs[:, 1])
+    
+    def _baseline(self, antecedents):
+        """
+        For each antecedent and each value B, the rate of B among the
+        languages with values for both features
+        """
+        value_features = self.value_codes.feature.to_numpy()
+        antecedent_features = value_features[antecedents]
+        # Languages with B and a value for the antecedent's feature
+        with_b = self.coverage[:, antecedent_features].T
+        both = self.joint_coverage[antecedent_features][:, value_features]
+        return with_b / both
+    
+    def _table(self, antecedents, consequents):
+        value_features = self.value_codes.feature.to_numpy()
+        together = np.asarray(self.counts[antecedents, consequents]).ravel()
+        support = self.coverage[antecedents, value_features[consequents]]
+        with_b = self.coverage[consequents, value_features[antecedents]]
+        both = self.joint_coverage[value_features[antecedents], value_features[consequents]]
+        result = pd.DataFrame({
+            'antecedent': self.value_codes.ID.to_numpy(dtype=object)[antecedents],
+            'consequent': self.value_codes.ID.to_numpy(dtype=object)[consequents],
+            'antecedent_name': self.value_names[antecedents],
+            'consequent_name': self.value_names[consequents],
+            'support': support,
+            'count': together,
+        })
+        result['probability'] = together / support
+        result['baseline'] = with_b / both
+        result['lift'] = result.probability / result.baseline
+        return result
+    
+    def implication(self, antecedent, consequent):
+        """The row of the implications table for two value IDs, e.g. '83A-2', '85A-1'"""
+        ids = pd.Index(self.value_codes.ID)
+        return self._table(ids.get_indexer([antecedent]), ids.get_indexer([consequent])).iloc[0]
+
+
+def feature_order(feature_id):
+    """Sort key putting feature IDs in numerical order, e.g. 2A before 10A"""
+    return int(feature_id[:-1]), feature_id[-1:]
+
+
+def sample_of_density(
+    density_threshold,
+    n_features_to_drop=1,
+    n_languages_to_drop=2,
+    drop_redundant=False,
+    use_cache=True,
+):
+    """
+    The sample chosen by iteratively dropping features and languages until
+    the given density is reached.
+
+    Unless use_cache is False, the built sample is saved on disk, keyed on
+    the contents of the data files and on the parameters, so it only has
+    to be built once.
+    """
+    def build():
+        sample = Sample(
+            choose_and_evaluate_features_and_languages(
+                present_values,
+                density_threshold=density_threshold,
+                n_features_to_drop=n_features_to_drop,
+                n_languages_to_drop=n_languages_to_drop,
+                verbose=False,
+            )
+        )
+        if drop_redundant:
+            sample = sample.drop_redundant()
+        return sample
+
+    if not use_cache:
+        return build()
+    key = cache.key_of(
+        'sample_of_density',
+        sample_version,
+        EncodingPipeline.version,
+        impute.imputer_version,
+        store.store_version,
+        data_hash(),
+        treatment_hash(),
+        density_threshold,
+        n_features_to_drop,
+        n_languages_to_drop,
+        drop_redundant,
+        tuple(redundant_features),
     )
+    return cache.load_or_build('samples', key, build)
+
+
+def data_hash():
+    """A hash of the contents of all the data files the samples are built from"""
+    return cache.key_of(*(store.source_hash(name) for name in data_tables))
+
+
+def treatment_hash():
+    """A hash of how feature_treatment encodes each feature"""
+    return cache.key_of(*(
+        (
+            feature,
+            type(encoder).__name__,
+            getattr(encoder, 'n', None),
+            tuple(sorted(
+                (key, tuple(value) if isinstance(value, list) else value)
+                for key, value in encoder.recode.items()
+            )),
+        )
+        for feature, encoder in sorted(feature_treatment.items())
+    ))
 
 
 class Ordinal(base.TransformerMixin):
@@ -185,10 +886,26 @@ class Ordinal(base.TransformerMixin):
     
     def fit(self, x, y=None):
         self._feature_names = list(x.columns)
+        # Column i of the lookup table holds the recoded value of code i - 1
+        max_code = max(list(self.recode) + [0])
+        self._table = np.arange(-1, max_code + 1)
+        for key, value in self.recode.items():
+            if key >= -1:
+                self._table[key + 1] = value
         return self
     
     def transform(self, x):
-        return x.replace(self.recode)
+        return pd.DataFrame(
+            np.column_stack([self.lookup(x[col].to_numpy()) for col in x.columns]),
+            columns=self.get_feature_names(),
+            index=x.index,
+        )
+    
+    def lookup(self, codes):
+        """Recode one column of codes, as a column vector"""
+        in_table = (codes >= -1) & (codes < len(self._table) - 1)
+        result = np.where(in_table, self._table[np.where(in_table, codes + 1, 0)], codes)
+        return result[:, np.newaxis]
     
     def get_feature_names(self):
         return self._feature_names
@@ -228,25 +945,49 @@ class OneHot(base.TransformerMixin):
             for value in range(1, self.n + 1)
             if value not in removed_not_restored_values
         ]
+        self._compile()
         return self
     
-    def transform(self, x):
-        result = pd.DataFrame()
-        for col, value in self.new_cols:
-            col_name = f'{col}_{value}'
-            if value in self._removed_values:
-                result[col_name] = 0
-            else:
-                result[col_name] = (x[col] == value).astype(int)
-        for col in x.columns:
-            for key, values in self.recode.items():
+    def _compile(self):
+        """
+        Build the lookup table: row i holds the one-hot encoding of code
+        i - 1, so the missing code -1 maps to the first row (all -1's), and
+        the last row (all zeros) catches codes with no row of their own.
+        """
+        new_values = [
+            value for value in range(1, self.n + 1)
+            if (self.new_cols[0][0], value) in self.new_cols
+        ] if self.new_cols else []
+        positions = {value: i for i, value in enumerate(new_values)}
+        max_code = max([self.n] + list(self.recode))
+        self._table = np.zeros((max_code + 3, len(new_values)), dtype=int)
+        self._table[0] = -1
+        for value in new_values:
+            if value not in self._removed_values:
+                self._table[value + 1, positions[value]] = 1
+        recoded = [(key, values) for key, values in self.recode.items() if values]
+        if new_values and new_values[0] in self._removed_values:
+            # The original column-by-column encoding lost the first recoded
+            # value in this case (so 70A's value 1 encodes as all zeros).
+            # Keep that behaviour so the encoded samples don't change.
+            recoded = recoded[1:]
+        for key, values in recoded:
+            if key >= 0:
                 for value in values:
-                    col_name = f'{col}_{value}'
-                    result[col_name] = result[col_name] | (x[col] == key).astype(int)
-        for col, value in self.new_cols:
-            col_name = f'{col}_{value}'
-            result[col_name] = result[col_name].mask(x[col] == -1, -1)
-        return result
+                    self._table[key + 1, positions[value]] = 1
+    
+    def transform(self, x):
+        return pd.DataFrame(
+            np.column_stack([self.lookup(x[col].to_numpy()) for col in x.columns]),
+            columns=self.get_feature_names(),
+            index=x.index,
+        )
+    
+    def lookup(self, codes):
+        """One-hot encode one column of codes, with one row per code"""
+        zero_row = len(self._table) - 1
+        in_table = (codes >= -1) & (codes < zero_row - 1)
+        return self._table[np.where(in_table, codes + 1, zero_row)]
     
     def get_feature_names(self):
         return [f'{col}_{value}' for col, value in self.new_cols]
@@ -257,17 +998,100 @@ class PandasColumnTransformer(base.TransformerMixin):
         self.transformers = transformers
     
     def fit(self, x, y=None):
+        self._columns = []
+        self._feature_names = []
         for col, transformer in self.transformers.items():
             if col in x:
                 transformer.fit(x[[col]], y)
+                names = transformer.get_feature_names()
+                self._columns.append((
+                    col,
+                    transformer,
+                    slice(len(self._feature_names), len(self._feature_names) + len(names)),
+                ))
+                self._feature_names.extend(names)
         return self
     
     def transform(self, x):
-        result = []
-        for col, transformer in self.transformers.items():
-            if col in x:
-                result.append(transformer.transform(x[[col]]))
-        return pd.concat(result, axis=1)
+        result = np.empty((len(x), len(self._feature_names)), dtype=int)
+        for col, transformer, columns in self._columns:
+            result[:, columns] = transformer.lookup(x[col].to_numpy())
+        return pd.DataFrame(result, columns=self._feature_names, index=x.index)
+    
+    def get_feature_names(self):
+        return self._feature_names
+
+    
+class EncodingPipeline:
+    """
+    The steps that turn a values matrix into scaled, imputed feature columns.
+    
+    The steps are: encode each feature according to feature_treatment,
+    drop the encoded columns with no variation, scale every column to
+    range from 0 to 1, and impute missing values from the nearest
+    languages. Once fitted, new or updated languages can be pushed through
+    the same steps with transform, without refitting anything.
+    
+    Pipelines are versioned, and load_pipeline refuses to load one saved
+    by a different version of this class.
+    """
+    version = 2
+    
+    def fit(self, values_matrix):
+        self.features_list = list(values_matrix.columns)
+        self.encoder = PandasColumnTransformer(copy.deepcopy(feature_treatment))
+        encoded = self.encoder.fit_transform(values_matrix)
+        nunique = encoded.replace(-1, np.nan).nunique()
+        self.no_variation_cols = list(nunique[nunique == 1].index)
+        encoded = encoded.drop(self.no_variation_cols, axis=1)
+        self.columns = list(encoded.columns)
+        
+        self.scaler = pipeline.Pipeline([
+            ('missing', pre.FunctionTransformer(to_float)),
+            ('scaler', pre.MinMaxScaler((0, 1))),
+        ])
+        scaled = self.scale(encoded, fit=True)
+        
+        self.imputer = impute.NeighbourImputer()
+        self.imputer.fit(scaled)
+        return self
+    
+    def encode(self, values_matrix):
+        """
+        Encode the rows of a values matrix, dropping the no-variation
+        columns. Features the pipeline wasn't fitted on are ignored, and
+        missing ones are treated as missing values.
+        """
+        values_matrix = values_matrix.reindex(columns=self.features_list, fill_value=-1)
+        return self.encoder.transform(values_matrix).drop(self.no_variation_cols, axis=1)
+    
+    def scale(self, encoded, fit=False):
+        scaled = self.scaler.fit_transform(encoded) if fit else self.scaler.transform(encoded)
+        return pd.DataFrame(scaled, columns=self.columns, index=encoded.index)
+    
+    def impute(self, scaled):
+        return pd.DataFrame(
+            self.imputer.transform(scaled), columns=self.columns, index=scaled.index,
+        )
+    
+    def transform(self, values_matrix):
+        """The scaled, imputed feature columns for the rows of a values matrix"""
+        return self.impute(self.scale(self.encode(values_matrix)))
+    
+    def save(self, path):
+        cache.store(path, self)
+
+
+def load_pipeline(path):
+    """Load an EncodingPipeline saved with EncodingPipeline.save"""
+    with open(path, 'rb') as f:
+        result = pickle.load(f)
+    if getattr(result, 'version', None) != EncodingPipeline.version:
+        raise ValueError(
+            f'{path} holds an encoding pipeline from version {getattr(result, "version", None)}, '
+            f'but this is version {EncodingPipeline.version}'
+        )
+    return result
 
     
 def to_float(df):
@@ -493,8 +1317,18 @@ def get_shortname(feature_code):
         return feature_code
 
 
-s229 = sample_of_density(0.98)
-s229d = s229.drop_redundant()
+# The standard samples are only built (or loaded from the cache) when first used
+_standard_samples = {
+    's229': dict(density_threshold=0.98),
+    's229d': dict(density_threshold=0.98, drop_redundant=True),
+    's280': dict(density_threshold=0.95),
+    's280d': dict(density_threshold=0.95, drop_redundant=True),
+}
+
 
-s280 = sample_of_density(0.95)
-s280d = s280.drop_redundant()
\ No newline at end of file
+def __getattr__(name):
+    if name in _standard_samples:
+        sample = sample_of_density(**_standard_samples[name])
+        globals()[name] = sample
+        return sample
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file